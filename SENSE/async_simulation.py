@@ -0,0 +1,215 @@
+"""
+Asyncio-native simulation and evaluation for a single scene
+"""
+import copy
+import json
+import random
+import openai
+from openai import AsyncOpenAI
+from simulation import Simulation, END_QUESTION
+from utils.eval_scheduler import EvalScheduler
+from utils.client_pool import CLIENTS
+from utils.rate_limit import LIMITS
+from utils.choice_scoring import YES_NO, CHOICE_INSTRUCTION, scoring_config, choice_request, choice_distribution, format_choice
+from utils.model_utils import STOP_STATS, split_stop_params, check_stopped, truncated_completion
+
+# keys of an llm config consumed by the client rather than the completion request
+CLIENT_KEYS = ("base_url", "api_key", "api_type", "model_client_cls", "http_client", "default_headers")
+
+# async clients shared by all scenes of the process, keyed by (base_url, api_key, api_type)
+_async_clients = {}
+
+
+def get_async_client(base_url, api_key, api_type=None):
+    key = (base_url, api_key, api_type)
+    if key not in _async_clients:
+        _async_clients[key] = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=CLIENTS.get_async(base_url, api_key, api_type))
+    return _async_clients[key]
+
+
+async def close_async_clients():
+    _async_clients.clear()
+    await CLIENTS.a_close()
+
+
+class AsyncSimulation(Simulation):
+    """Drive the group chat and all interviews of a scene as coroutines, with
+    the same agents, transforms and result format as `Simulation`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # autogen clients keep the config they were built with, so snapshot it
+        # to issue exactly the same requests
+        self.llm_configs = {name: copy.deepcopy(agent.llm_config['config_list'][0]) for name, agent in self.agent_dict.items()}
+        if self.termination is not None:
+            self.termination.a_classifier = self.classify_ended
+
+    async def generate_reply(self, agent, messages, cache=None, truncate=False):
+        """generate a reply of an agent from its view of the messages, with server-side
+        truncation of dialog turns when the llm config has stop sequences"""
+        response = await self.chat_completion(agent, messages, cache, truncate)
+        content = response.choices[0].message.content
+        return content if content is not None else ""
+
+    async def chat_completion(self, agent, messages, cache=None, truncate=False, **overrides):
+        """the completion of an agent from its view of the messages, with `overrides` of its llm config"""
+        config = self.llm_configs[agent.name]
+        messages = agent.process_all_messages_before_reply(messages)
+        params = {k: v for k, v in config.items() if k not in CLIENT_KEYS}
+        if not truncate:
+            params.pop("stop", None)
+        params.update(overrides)
+        params["messages"] = [{"content": agent.system_message, "role": "system"}] + messages
+
+        async def create():
+            # keyed in the same format as autogen get_key, so both engines share cached responses
+            key = json.dumps(params, sort_keys=True)
+            response = cache.get(key) if cache is not None else None
+            if response is None:
+                response = await LIMITS.a_call(config['base_url'], self.create, config, params)
+                if cache is not None:
+                    cache.set(key, response)
+            return response
+
+        if self.recorder is not None:
+            role = 'judge' if agent in self.judge_agents else 'agent'
+            response = await self.recorder.a_call(create, self.labels, agent.name, role, config)
+        else:
+            response = await create()
+        return response
+
+    async def create(self, config, params):
+        """the asyncio counterpart of StopSequenceClient.create"""
+        client = get_async_client(config['base_url'], config['api_key'], config.get('api_type'))
+        if config.get('default_headers'):
+            params = dict(params, extra_headers=config['default_headers'])
+        if "stop" not in params:
+            return await client.chat.completions.create(**params)
+        endpoint = config['base_url']
+        trunc_symbol, params = split_stop_params(params)
+        max_tokens = params.get("max_tokens") or 0
+        if not STOP_STATS.ignores_stop(endpoint):
+            response = await client.chat.completions.create(**params)
+            return check_stopped(response, trunc_symbol, endpoint, max_tokens)
+
+        text, chunk, n_chunks = "", None, 0
+        stream = await client.chat.completions.create(stream=True, **params)
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    n_chunks += 1
+                    if trunc_symbol in text:
+                        break
+        finally:
+            # closing the connection aborts the generation on the server
+            await stream.close()
+        STOP_STATS.record(endpoint, 'stream', max_tokens - n_chunks if trunc_symbol in text else 0)
+        return truncated_completion(chunk, text.split(trunc_symbol)[0])
+
+    async def run(self,):
+        # simulation
+        await self.simulate()
+        # reset the temperature for evaluation
+        self.prepare_eval()
+        # evaluation
+        await self.evaluate()
+        return self.save()
+
+    async def rejudge(self, chat_history):
+        """ evaluate a saved transcript without re-running the simulation """
+        self.chat_history = chat_history
+        self.prepare_eval()
+        await self.evaluate()
+        return self.save()
+
+    async def simulate(self):
+        """ run the group chat of the scene following the rounds of autogen GroupChatManager,
+        resuming from the journaled turns if any """
+        turns = list(self.journal.turns) if self.journal is not None else []
+        reason = self.journal.stop if self.journal is not None else None
+        if not turns:
+            turns.append((random.choice(self.agents).name, "Hi, there!"))
+            if self.journal is not None:
+                self.journal.record_turn(*turns[0])
+        if self.termination is not None and reason is None:
+            for name, content in turns[:-1]:
+                self.termination.observe(name, content)
+            if await self.termination.a_call(*turns[-1]):
+                reason = self.termination.reason
+        # the history seen by each agent, extended in place so that transformed messages are reused
+        views = {agent.name: self.view(turns, agent.name) for agent in self.agents}
+        speaker = self.agent_dict[turns[-1][0]]
+        cache = self.role_cache('dialog', self.agents)
+        for _ in range(len(turns), self.group_chat.max_round):
+            if reason is not None:
+                break
+            speaker = self.group_chat.select_speaker(speaker, self.chat_manager)
+            reply = await self.generate_reply(speaker, views[speaker.name], cache, truncate=True)
+            turns.append((speaker.name, reply))
+            for agent in self.agents:
+                views[agent.name].extend(self.view(turns[-1:], agent.name))
+            if self.journal is not None:
+                self.journal.record_turn(speaker.name, reply)
+            if self.termination is not None and await self.termination.a_call(speaker.name, reply):
+                reason = self.termination.reason
+        self.chat_history = views[turns[0][0]]
+        self.finish_dialog(reason)
+
+    def load_scoring_client(self, agent, role):
+        # scoring requests are sent by chat_completion
+        return None
+
+    async def choice_interview(self, key, agent_name, question, chat_history, choices):
+        """the asyncio counterpart of Simulation.choice_interview"""
+        agent = self.agent_dict[agent_name]
+        kind = 'goal' if choices == YES_NO else 'info'
+        try:
+            response = await self.chat_completion(agent, chat_history+[{
+                "content":question + CHOICE_INSTRUCTION[kind],
+                "role":"user"
+            }], agent.client_cache, **scoring_config(self.choice_scoring), **choice_request(self.choice_scoring, choices))
+            dist = choice_distribution(response, choices)
+        except openai.BadRequestError:
+            dist = None
+        self.count_choice(agent_name, dist is None)
+        if dist is None:
+            return await self.interview_agent(agent_name, question, chat_history)
+        self.record_dist(key, dist)
+        return format_choice(max(choices, key=dist.get), choices)
+
+    async def classify_ended(self, turns):
+        """ the asyncio counterpart of Simulation.classify_ended """
+        judge = self.judge_agents[0]
+        return 'Yes' in await self.interview_agent(judge.name, END_QUESTION, self.view(turns, judge.name))
+
+    async def interview_agent(self, agent_name, question, chat_history):
+        """interview an assigned agent """
+        if isinstance(question, list) and len(question)==1:
+            question = question[0]
+        agent = self.agent_dict[agent_name]
+        return await self.generate_reply(agent, chat_history+[{
+            "content":question,
+            "role":"user"
+        }], agent.client_cache)
+
+    async def evaluate(self):
+        """ evaluate goal completion and private info reasoning with all interviews dispatched together """
+        scheduler = EvalScheduler(self.eval_concurrency, self.journal, self.prefix_warmup)
+        self.add_goal_requests(scheduler, self.chat_history)
+        self.add_info_requests(scheduler, self.chat_history)
+        results = await scheduler.a_run()
+        self.goal_eval_res = self.collect_goal_results(results)
+        self.info_eval_res = self.collect_info_results(results)
+
+    async def eval_goal(self):
+        """ evaluate goal completion """
+        scheduler = EvalScheduler(self.eval_concurrency, self.journal, self.prefix_warmup)
+        self.add_goal_requests(scheduler, self.chat_history)
+        self.goal_eval_res = self.collect_goal_results(await scheduler.a_run())
+
+    async def eval_info(self):
+        """ evaluate private info reasoning """
+        scheduler = EvalScheduler(self.eval_concurrency, self.journal, self.prefix_warmup)
+        self.add_info_requests(scheduler, self.chat_history)
+        self.info_eval_res = self.collect_info_results(await scheduler.a_run())
@@ -0,0 +1,241 @@
+"""
+Offline stand-in for an OpenAI-compatible chat completions server
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("the we should think about plan time meeting agree really maybe help "
+         "project friend family work idea sure need want together know").split()
+
+
+def parse_latency(spec):
+    """sampler of latencies in seconds from a spec like const:0.05, uniform:0.01,0.1,
+    lognormal:<mu>,<sigma> or exp:<mean>"""
+    kind, _, params = spec.partition(':')
+    params = [float(p) for p in params.split(',')] if params else []
+    if kind == 'const':
+        return lambda rng: params[0] if params else 0.0
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(params[0], params[1])
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(params[0], params[1])
+    if kind == 'exp':
+        return lambda rng: rng.expovariate(1 / params[0])
+    raise NotImplementedError("unsupported latency distribution: {}".format(kind))
+
+
+class MockBackend:
+    """Responses, latency and errors of the mock server.
+
+    Responses are drawn from `responses` (canned, picked by the hash of the
+    request) or generated from a generator seeded by the request and `seed`, so
+    the same request always gets the same response. Multiple-choice questions are
+    answered with one of their option marks and other questions start with Yes or No.
+    """
+
+    def __init__(self, latency='const:0', token_latency=0.0, error_rate=0.0, error_codes=(429, 500),
+                 responses=None, seed=0, newline_rate=0.3):
+        self.latency = parse_latency(latency)
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.responses = responses
+        self.seed = seed
+        self.newline_rate = newline_rate
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def request_rng(self, body):
+        digest = hashlib.sha256(json.dumps([self.seed, body.get("messages")], sort_keys=True).encode('utf-8')).digest()
+        return random.Random(digest)
+
+    def generate(self, body, rng):
+        if self.responses:
+            return self.responses[rng.randrange(len(self.responses))]
+        question = str(body["messages"][-1].get("content", "")) if body.get("messages") else ""
+        marks = re.findall(r'\(([1-9A-Za-z])\)', question.split('Options:')[-1]) if 'Options:' in question else []
+        if marks:
+            return '({})'.format(rng.choice(marks))
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 40)))
+        if rng.random() < self.newline_rate:
+            # a second line, dropped by the truncation of dialog turns
+            text += '\n' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 20)))
+        return '{}, {}.'.format(rng.choice(['Yes', 'No']), text)
+
+    def complete(self, body):
+        """(status, payload) of a request, after sleeping for its latency"""
+        with self.lock:
+            self.stats["requests"] += 1
+            latency = self.latency(self.rng)
+            failed = self.rng.random() < self.error_rate
+            status = self.rng.choice(self.error_codes) if failed else 200
+        if failed:
+            time.sleep(latency)
+            with self.lock:
+                self.stats["errors"] += 1
+            return status, {"error": {"message": "injected error", "type": "mock_error", "code": status}}
+
+        rng = self.request_rng(body)
+        text = self.generate(body, rng)
+        finish_reason, stop_reason = "stop", None
+        tokens = text.split(' ')
+        max_tokens = body.get("max_tokens")
+        if max_tokens and len(tokens) > max_tokens:
+            text, finish_reason = ' '.join(tokens[:max_tokens]), "length"
+        stop = body.get("stop") or []
+        stop = [stop] if isinstance(stop, str) else stop
+        positions = [(text.find(s), s) for s in stop if s in text]
+        if positions:
+            position, stop_reason = min(positions)
+            text, finish_reason = text[:position], "stop"
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        completion_tokens = len(text.split())
+        time.sleep(latency + self.token_latency * completion_tokens)
+        with self.lock:
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+        return 200, {
+            "id": "chatcmpl-mock-{}".format(rng.getrandbits(64)),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": finish_reason,
+                # as reported by vLLM
+                "stop_reason": stop_reason,
+            }],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        backend = self.server.backend
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+        elif self.path.rstrip('/').endswith('/metrics'):
+            data = ''.join('mock_{}_total {}\n'.format(k, v) for k, v in backend.stats.items()).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+        status, payload = self.server.backend.complete(body)
+        if status != 200 or not body.get("stream"):
+            self.send_json(status, payload)
+            return
+        self.send_stream(payload)
+
+    def send_stream(self, payload):
+        """send a completion as server-sent events, one chunk per word"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        choice = payload["choices"][0]
+        words = re.split(r'(?<= )', choice["message"]["content"])
+        chunks = [{"role": "assistant", "content": ""}] + [{"content": w} for w in words if w]
+        for i, delta in enumerate(chunks + [{}]):
+            chunk = {"id": payload["id"], "object": "chat.completion.chunk", "created": payload["created"], "model": payload["model"],
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": choice["finish_reason"] if i == len(chunks) else None}]}
+            self.write_chunk('data: {}\n\n'.format(json.dumps(chunk)))
+        self.write_chunk('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+
+class MockServer:
+    """A mock server running on a background thread, e.g. for benchmarks."""
+
+    def __init__(self, host='127.0.0.1', port=0, **backend_kwargs):
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.backend = MockBackend(**backend_kwargs)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}/v1'.format(host, port)
+
+    @property
+    def stats(self):
+        return self.httpd.backend.stats
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=str, default='const:0', help='latency distribution of requests in seconds, choose from [const:<s>, uniform:<lo>,<hi>, lognormal:<mu>,<sigma>, exp:<mean>]')
+    parser.add_argument('--token_latency', type=float, default=0, help='additional seconds per completion token')
+    parser.add_argument('--error_rate', type=float, default=0, help='fraction of requests failed with one of error_codes')
+    parser.add_argument('--error_codes', type=str, default='429,500', help='comma-separated status codes of injected errors')
+    parser.add_argument('--responses', type=str, default=None, help='path of a json list of canned responses, otherwise generated')
+    parser.add_argument('--seed', type=int, default=0, help='seed of generated responses, latency and errors')
+    args = parser.parse_args()
+
+    responses = json.load(open(args.responses, 'r')) if args.responses else None
+    server = MockServer(args.host, args.port, latency=args.latency, token_latency=args.token_latency,
+                        error_rate=args.error_rate, error_codes=[int(c) for c in args.error_codes.split(',')],
+                        responses=responses, seed=args.seed)
+    print('Serving mock chat completions at {}'.format(server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__=="__main__":
+    main()
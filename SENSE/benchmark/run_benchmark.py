@@ -0,0 +1,150 @@
+"""
+Benchmark of the overhead of the harness, running run_eval.py end to end against the mock server
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from mock_server import MockServer, WORDS
+
+SENSE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sentence(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n)).capitalize() + '.'
+
+
+def make_scenes(num_scenes, base_url, num_characters=2, num_goals=2, num_info=2, scenes_per_template=5, seed=0):
+    """synthetic scenes in the format of final_data.jsonl"""
+    rng = random.Random(seed)
+    scenes = []
+    for i in range(num_scenes):
+        names = ['Agent{}'.format(j) for j in range(num_characters)]
+        characters = []
+        for name in names:
+            others = [other for other in names if other != name]
+            characters.append({
+                "name": name,
+                "profile": sentence(rng, 30),
+                "private_info": sentence(rng, 20),
+                "goals": [{
+                    "goal": sentence(rng, 10),
+                    "eval_questions": {
+                        "self": [{"question": "Did you achieve it? " + sentence(rng, 10), "obj": name}],
+                        "others": [{"question": "Did {} achieve it? ".format(name) + sentence(rng, 10), "obj": other} for other in others],
+                        "judge": [{"question": "Did {} achieve it? ".format(name) + sentence(rng, 10)}],
+                    },
+                } for _ in range(num_goals)],
+                "info_reason_questions": [{
+                    "question": sentence(rng, 12),
+                    "options": [sentence(rng, 4) for _ in range(4)],
+                    "answer_label": rng.randrange(4),
+                } for _ in range(num_info)],
+                "model": "mock-agent",
+                "base_url": base_url,
+                "api_key": "mock",
+                "api_type": "openai",
+            })
+        scenes.append({
+            "sample_idx": i,
+            "template_idx": i // scenes_per_template,
+            "background": sentence(rng, 60),
+            "description": sentence(rng, 30),
+            "characters": characters,
+        })
+    return scenes
+
+
+def make_judge_config(base_url, num_judges=3):
+    return [{
+        "judge_model": "mock-judge-{}".format(i),
+        "judge_base_url": base_url,
+        "judge_api_key": "mock",
+        "judge_api_type": "openai",
+        "judge_temperature": 0,
+        "judge_max_tokens": 128,
+    } for i in range(num_judges)]
+
+
+def run_once(num_scenes, server, work_dir, args, extra_args):
+    """run run_eval.py on synthetic scenes and measure its wall time, cpu time and peak rss"""
+    run_dir = os.path.join(work_dir, '{}_scenes'.format(num_scenes))
+    os.makedirs(run_dir, exist_ok=True)
+    input_path = os.path.join(run_dir, 'data.jsonl')
+    with open(input_path, 'w') as f:
+        for scene in make_scenes(num_scenes, server.url, args.num_characters, args.num_goals, args.num_info, seed=args.seed):
+            f.write(json.dumps(scene) + '\n')
+    judge_config = os.path.join(run_dir, 'judge_config.json')
+    with open(judge_config, 'w') as f:
+        json.dump(make_judge_config(server.url, args.num_judges), f)
+    output_dir = os.path.join(run_dir, 'output')
+
+    cmd = [sys.executable, 'run_eval.py', '--pattern', 'heter', '--input_path', input_path,
+           '--output_dir', output_dir, '--judge_config', judge_config,
+           '--prompt_template_path', os.path.join(SENSE_DIR, 'configs', 'prompt_template.json'),
+           '--max_round', str(args.max_round), '--task_workers', str(args.task_workers),
+           '--engine', args.engine, '--no_journal'] + extra_args
+    requests_before = server.stats["requests"]
+    start = time.perf_counter()
+    with open(os.path.join(run_dir, 'stdout.txt'), 'w') as out:
+        proc = subprocess.Popen(cmd, cwd=SENSE_DIR, stdout=out, stderr=subprocess.STDOUT)
+        # the rusage of this child only, unlike RUSAGE_CHILDREN which accumulates over runs
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError('run_eval.py failed with {} scenes, see {}'.format(num_scenes, os.path.join(run_dir, 'stdout.txt')))
+
+    calls = server.stats["requests"] - requests_before
+    cpu = rusage.ru_utime + rusage.ru_stime
+    return {
+        "scenes": num_scenes,
+        "calls": calls,
+        "wall_sec": round(wall, 3),
+        "scenes_per_sec": round(num_scenes / wall, 3),
+        "cpu_sec": round(cpu, 3),
+        "cpu_ms_per_call": round(1000 * cpu / calls, 3) if calls else None,
+        # kilobytes on linux
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=str, default='10,100,1000', help='comma-separated numbers of synthetic scenes')
+    parser.add_argument('--work_dir', type=str, default=None, help='dir of the synthetic data and outputs, a temporary dir if not given')
+    parser.add_argument('--report', type=str, default=None, help='path of the json report')
+    parser.add_argument('--engine', type=str, default='thread', help='execution engine of scenes, choose from [thread, async]')
+    parser.add_argument('--task_workers', type=int, default=4)
+    parser.add_argument('--max_round', type=int, default=15)
+    parser.add_argument('--num_characters', type=int, default=2)
+    parser.add_argument('--num_goals', type=int, default=2, help='num of goals per character')
+    parser.add_argument('--num_info', type=int, default=2, help='num of info questions per character')
+    parser.add_argument('--num_judges', type=int, default=3)
+    parser.add_argument('--latency', type=str, default='const:0', help='latency distribution of the mock server, see mock_server.py')
+    parser.add_argument('--error_rate', type=float, default=0, help='fraction of requests failed by the mock server')
+    parser.add_argument('--seed', type=int, default=0)
+    args, extra_args = parser.parse_known_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='sense_bench_')
+    results = []
+    with MockServer(latency=args.latency, error_rate=args.error_rate, seed=args.seed) as server:
+        print('mock server at {}, work dir {}'.format(server.url, work_dir))
+        for size in [int(s) for s in args.sizes.split(',')]:
+            result = run_once(size, server, work_dir, args, extra_args)
+            results.append(result)
+            print('{scenes:>6} scenes | {calls:>8} calls | {wall_sec:>9.2f} s | {scenes_per_sec:>8.3f} scenes/s | '
+                  '{cpu_ms_per_call} ms cpu/call | {peak_rss_mb} MB peak rss'.format(**result))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({"args": vars(args), "extra_args": extra_args, "results": results}, f, indent=2)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Paired comparison of the scores of two runs on the same scenes
+"""
+
+import argparse
+from utils.result_store import open_result_store
+from utils.results_table import load_run_results
+from utils.stats import compare_runs, bootstrap_report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_path', type=str, default="./data/final_data.jsonl", help='path of the file of scenario setting of both runs')
+    parser.add_argument('--output_dirs', type=str, nargs=2, required=True, help='output dirs of the two runs')
+    parser.add_argument('--models', type=str, nargs=2, default=['A', 'B'], help='names of the two runs, also their models in sqlite result stores')
+    parser.add_argument('--pattern', type=str, default='homo', help='pattern of the runs in sqlite result stores')
+    parser.add_argument('--judge_tag', type=str, default=None, help='sub-dir of the output dirs holding the results, for runs of the eval phase')
+    parser.add_argument('--result_store', type=str, default='json', help='store of the scene results of the runs, choose from [json, sqlite]')
+    parser.add_argument('--result_dbs', type=str, nargs=2, default=None, help='paths of the sqlite files of the two runs with --result_store sqlite, may be the same file, default to results.db in each output dir')
+    parser.add_argument('--bootstrap', type=int, default=10000, help='num of bootstrap replicates')
+    parser.add_argument('--alpha', type=float, default=0.05, help='the confidence intervals are at level 1-alpha')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the resampling')
+    args = parser.parse_args()
+
+    runs = []
+    db_paths = args.result_dbs or [None] * len(args.output_dirs)
+    for output_dir, model, db_path in zip(args.output_dirs, args.models, db_paths):
+        store = open_result_store(args.result_store, output_dir, args.judge_tag, model, args.pattern, db_path)
+        all_res, templates = load_run_results(store, args.input_path)
+        store.close()
+        if not all_res:
+            raise Exception("No scene results found in {}.".format(output_dir))
+        runs.append(all_res)
+
+    level = '{:g}'.format(100 * (1 - args.alpha))
+    for model, all_res in zip(args.models, runs):
+        for metric, ci in bootstrap_report(all_res, templates, args.bootstrap, args.alpha, args.seed).items():
+            print('{} {}: {:.4f} {}% CI [{:.4f}, {:.4f}] scenes: {}'.format(model, metric, ci['score'], level, ci['low'], ci['high'], ci['scenes']))
+    # differences over the scenes scored in both runs, resampled in pairs within templates
+    for metric, test in compare_runs(runs[0], runs[1], templates, args.bootstrap, args.alpha, args.seed).items():
+        print('{} - {} {}: {:+.4f} {}% CI [{:+.4f}, {:+.4f}] p-value: {:.4f} scenes: {}'.format(
+            args.models[0], args.models[1], metric, test['diff'], level, test['low'], test['high'], test['p_value'], test['scenes']))
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Export the results of a run into a long-format columnar table
+"""
+
+import argparse
+from utils.results_table import load_run_results, results_table, write_table
+from utils.result_store import open_result_store
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_path', type=str, default="./data/final_data.jsonl", help='path of the file of scenario setting of the run')
+    parser.add_argument('--output_dir', type=str, required=True, help='output dir of the run')
+    parser.add_argument('--judge_tag', type=str, default=None, help='sub-dir of output_dir holding the results, for runs of the eval phase')
+    parser.add_argument('--model', type=str, required=True, help='name of the run in the model column of the table, and the model of the run in the sqlite result store')
+    parser.add_argument('--pattern', type=str, default='homo', help='pattern of the run in the sqlite result store')
+    parser.add_argument('--result_store', type=str, default='json', help='store of the scene results of the run, choose from [json, sqlite]')
+    parser.add_argument('--result_db', type=str, default=None, help='path of the sqlite file of --result_store sqlite, default to output_dir/results.db')
+    parser.add_argument('--table', type=str, required=True, help='path of the table, parquet (requires pyarrow) or .npz')
+    args = parser.parse_args()
+
+    store = open_result_store(args.result_store, args.output_dir, args.judge_tag, args.model, args.pattern, args.result_db)
+    all_res, templates = load_run_results(store, args.input_path)
+    store.close()
+    if not all_res:
+        raise Exception("No scene results found in {}.".format(args.output_dir))
+    table = results_table(args.model, all_res, templates)
+    write_table(table, args.table)
+    print('Exported {} rows of {} scenes to {}'.format(len(table['score']), len(all_res), args.table))
+
+
+if __name__=="__main__":
+    main()
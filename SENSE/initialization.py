@@ -8,6 +8,9 @@ from string import Template
 import autogen
 from autogen import ConversableAgent, GroupChat
 from utils.data_utils import question_with_options
+from utils.model_utils import MODEL_CLIENTS
+from utils.client_pool import CLIENTS
+from utils.routing import replicas
 
 def fill_prompt_template(prompt_template, name, profile, social_goal, private_info, background, desc) -> str:
     """Fill the placeholders in the prompt template"""
@@ -37,6 +40,10 @@ def load_scene(scene_config:Dict):
 
 
 def load_llm_config(llm_config: Dict):
+    # share the connection pool of the endpoint with all agents and judges, the requests
+    # to a model served by several replicas being routed by the pool
+    llm_config = dict(llm_config, base_url=replicas(llm_config["base_url"])[0],
+                      http_client=CLIENTS.get(llm_config["base_url"], llm_config["api_key"], llm_config.get("api_type")))
     llm_config = {"config_list": [llm_config], "cache_seed": None}
     return llm_config
 
@@ -56,6 +63,7 @@ def load_agent(agent_config: Dict, scene_config: Dict) -> ConversableAgent:
     }
 
     agent = ConversableAgent(**valid_agent_config)
+    register_model_clients(agent)
     return agent
 
 def load_judge_agent(agent_config:Dict):
@@ -67,22 +75,45 @@ def load_judge_agent(agent_config:Dict):
     }
 
     agent = ConversableAgent(**valid_agent_config)
+    register_model_clients(agent)
     return agent    
 
-def load_groupchat(agent_list: List, groupchat_config: Dict):
+def register_model_clients(agent):
+    """activate the custom model clients named in the llm config of an agent"""
+    for config in agent.llm_config['config_list']:
+        if 'model_client_cls' in config:
+            agent.register_model_client(model_client_cls=MODEL_CLIENTS[config['model_client_cls']])
+
+def set_stop_sequences(agent, enabled):
+    """switch the server-side stop sequences of an agent on or off"""
+    for client in agent.client._clients:
+        if hasattr(client, 'enabled'):
+            client.enabled = enabled
+
+def load_groupchat(agent_list: List, groupchat_config: Dict, is_termination_msg=None):
     group_chat = autogen.GroupChat(
         agent_list,
         **groupchat_config
     ) 
-    chat_manager = autogen.GroupChatManager(group_chat)
+    # the manager checks each message of the group chat, e.g. by a TerminationPolicy
+    chat_manager = autogen.GroupChatManager(group_chat, is_termination_msg=is_termination_msg)
     return group_chat, chat_manager
 
 
-def prepare_task_config(config_path):
-    """Read the yaml config of the given task in `tasks` directory."""
+def read_task_config(config_path):
+    """Read the yaml config of the given task in `tasks` directory, without its llm configs."""
     if not os.path.exists(config_path):
         raise ValueError(f"Task {config_path} not found.")
-    task_config = yaml.safe_load(open(config_path))
+    return yaml.safe_load(open(config_path))
+
+
+def prepare_task_config(config_path):
+    """Read the yaml config of the given task in `tasks` directory."""
+    return compile_task_config(read_task_config(config_path))
+
+
+def compile_task_config(task_config):
+    """Add the llm configs of agents to a task config built in memory or read from yaml."""
     for i, agent_configs in enumerate(task_config["agents"]):
         llm_config = load_llm_config(agent_configs.get("llm", None))
         agent_configs["llm_config"] = llm_config
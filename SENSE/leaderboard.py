@@ -0,0 +1,29 @@
+"""
+Leaderboard of the models of several runs, from their exported result tables
+"""
+
+import argparse
+import json
+from utils.aggregator import json_safe
+from utils.results_table import load_tables, leaderboard, format_leaderboard
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tables', type=str, nargs='+', required=True, help='paths of the result tables written by export.py or run_eval.py --results_table')
+    parser.add_argument('--output', type=str, default=None, help='path of a json file with the scene-level and template-level scores of every model, dim and judge')
+    args = parser.parse_args()
+
+    board = leaderboard(load_tables(args.tables))
+    if not board:
+        raise Exception("No results found in the tables.")
+    # template-level score of each dim, with the mean std within templates (PSI) in parentheses
+    print(format_leaderboard(board))
+    if args.output:
+        rows = [json_safe({name: board[name][i].item() for name in board}) for i in range(len(board['model']))]
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Merge the results of sharded runs
+"""
+
+import argparse
+import json
+import os
+from utils.logger import setup_logger
+from utils.aggregator import MetricAggregator
+from utils.result_store import open_result_store
+from run_eval import log_scene, report_results, run_model
+
+
+def load_shard_results(input_path, stores):
+    """metrics of the scenes of input_path found in the result stores of the shards,
+    and the template index of every scene"""
+    templates = {}
+    for line in open(input_path, 'r'):
+        line = json.loads(line)
+        templates[line['sample_idx']] = line['template_idx']
+    all_res = {}
+    for store in stores:
+        for scene_id, res in store.metrics(list(templates)).items():
+            all_res.setdefault(scene_id, res)
+    # in the order of input_path
+    all_res = {scene_id: all_res[scene_id] for scene_id in templates if scene_id in all_res}
+    missing = [scene_id for scene_id in templates if scene_id not in all_res]
+    return all_res, missing, templates
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_path', type=str, default="./data/final_data.jsonl", help='path of the file of scenario setting, the same as the sharded runs')
+    parser.add_argument('--shard_dirs', type=str, nargs='+', required=True, help='output dirs of the sharded runs')
+    parser.add_argument('--output_dir', type=str, default="./output/merged/", help='dir of the merged log')
+    parser.add_argument('--judge_tag', type=str, default=None, help='sub-dir of the shard dirs holding the results, when merging runs of the eval phase')
+    parser.add_argument('--result_store', type=str, default='json', help='store of the scene results of the shards, choose from [json, sqlite]')
+    parser.add_argument('--result_dbs', type=str, nargs='+', default=None, help='paths of the sqlite files of the shards with --result_store sqlite, default to results.db in each shard dir')
+    parser.add_argument('--model', type=str, default="Llama-2-13b-chat-hf", help='model of the sharded runs in the sqlite result store')
+    parser.add_argument('--pattern', type=str, default='homo', help='pattern of the sharded runs in the sqlite result store')
+    args = parser.parse_args()
+
+    logger = setup_logger('Merge', args.output_dir, 0)
+    db_paths = args.result_dbs or [None] * len(args.shard_dirs)
+    stores = [open_result_store(args.result_store, shard_dir, args.judge_tag, run_model(args), args.pattern, db_path)
+              for shard_dir, db_path in zip(args.shard_dirs, db_paths)]
+    all_res, missing, templates = load_shard_results(args.input_path, stores)
+    for store in stores:
+        store.close()
+    logger.info('Merged {} scenes from {} shard dirs'.format(len(all_res), len(args.shard_dirs)))
+    if missing:
+        logger.warning('{} scenes without results: {}'.format(len(missing), missing))
+    if not all_res:
+        raise Exception("No scene results found in the shard dirs.")
+    aggregator = MetricAggregator(templates, os.path.join(args.output_dir, 'summary.json'))
+    for scene_id, res in all_res.items():
+        log_scene(scene_id, res, logger)
+        aggregator.add(scene_id, res)
+    aggregator.write(final=True)
+    report_results(aggregator, logger)
+
+
+if __name__=="__main__":
+    main()
@@ -6,12 +6,21 @@ import re
 import numpy as np
 import statistics
 
+def nanmean(values):
+    # mean of the scores of the questions a judge was asked, nan if none
+    values = np.asarray(values, dtype=float)
+    return np.mean(values[~np.isnan(values)]) if (~np.isnan(values)).any() else np.nan
+
+
 class GoalMetric(object):
     def __init__(self):
         super().__init__()
 
     def judge(self, answer):
         # judge a single record
+        if answer is None:
+            # verdict skipped by the judge ensemble
+            return np.nan
         if 'Yes' in answer:
             return 1
         else:
@@ -33,8 +42,10 @@ class GoalMetric(object):
                         dim_res = np.mean(dim_res)
                         res[agent_name][goal][dim] = dim_res # avg of self/other
                     else:
-                        judge_avg = np.mean(dim_res)
-                        judge_mode = statistics.mode(dim_res)
+                        # over the judges queried by the ensemble
+                        queried = [score for score in dim_res if not np.isnan(score)]
+                        judge_avg = np.mean(queried)
+                        judge_mode = statistics.mode(queried)
                         dim_res.append(judge_avg)
                         dim_res.append(judge_mode)
                         res[agent_name][goal][dim] = dim_res # record by judge model
@@ -44,7 +55,7 @@ class GoalMetric(object):
             if 'others' in res[agent_name][goals[0]]:
                 res[agent_name]['others'] = np.mean([res[agent_name][goal]['others'] for goal in goals])
             for i in range(len(judge_agents)):
-                res[agent_name][judge_agents[i].name] = np.mean([res[agent_name][goal]['judge'][i] for goal in goals])
+                res[agent_name][judge_agents[i].name] = nanmean([res[agent_name][goal]['judge'][i] for goal in goals])
             res[agent_name]['judge_avg'] = np.mean([res[agent_name][goal]['judge'][-2] for goal in goals])    
             res[agent_name]['judge_majority'] = np.mean([res[agent_name][goal]['judge'][-1] for goal in goals])
         # avg by agents
@@ -54,7 +65,7 @@ class GoalMetric(object):
         if 'others' in res[agent_name]:
             res['others'] = np.mean([res[agent_name]['others'] for agent_name in agent_names])
         for i in range(len(judge_agents)):
-            res[judge_agents[i].name] = np.mean([res[agent_name][judge_agents[i].name] for agent_name in agent_names])
+            res[judge_agents[i].name] = nanmean([res[agent_name][judge_agents[i].name] for agent_name in agent_names])
         if 'judge_avg' in res[agent_name]:
             res['judge_avg'] = np.mean([res[agent_name]['judge_avg'] for agent_name in agent_names])
         if 'judge_majority' in res[agent_name]:
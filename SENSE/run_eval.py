@@ -3,148 +3,389 @@ Batch Evaluation
 """
 
 import argparse
+import asyncio
+import collections
 import json
 import os
-import numpy as np
+import time
 from tqdm import tqdm
-from utils.data_utils import generate_batch_config, generate_heter_batch_config, calculate_tmpl_res
+from utils.data_utils import build_batch_config, write_batch_config, bundle_key, load_task_bundle, save_task_bundle
 from utils.logger import setup_logger
+from utils.cache_utils import ResponseCache
+from utils.model_utils import STOP_STATS
+from utils.instrument import LLMCallRecorder, PrefixCacheProbe
+from utils.client_pool import CLIENTS
+from utils.rate_limit import LIMITS
+from utils.scene_scheduler import SceneCostModel, SceneScheduler
+from utils.aggregator import MetricAggregator
+from utils.results_table import results_table, write_table
+from utils.result_store import open_result_store
+from utils.stats import bootstrap_report
+from utils.routing import replicas
 from simulation import Simulation
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from async_simulation import AsyncSimulation, close_async_clients
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def process_task(config_file, args):
-    task = Simulation.from_task(os.path.join(args.config_dir, config_file), args.output_dir)
-    scene_id = task.scene['scene_id']
-    
-    output_path = os.path.join(args.output_dir, f'{scene_id}.json')
-    
-    if os.path.exists(output_path):
-        res = json.load(open(output_path, 'r'))
+def get_result_dir(args):
+    """dir of scene results, with re-judged results under the judge tag"""
+    if args.phase == 'eval':
+        return os.path.join(args.output_dir, args.judge_tag)
+    return args.output_dir
+
+
+def shard_suffix(args):
+    """suffix of the run-level files of a shard, which may share output_dir with the other shards"""
+    return '_shard{}'.format(args.shard_id) if args.num_shards > 1 else ''
+
+
+def run_model(args):
+    """name of the run in the result store and the results table"""
+    return args.model if args.pattern == 'homo' else args.pattern
+
+
+def load_transcript(scene_id, transcripts):
+    """chat history of a scene saved by a previous simulation"""
+    chat_history = transcripts.transcript(scene_id)
+    if chat_history is None:
+        raise ValueError(f"Transcript of scene {scene_id} not found in the results of the simulation.")
+    return chat_history
+
+
+def process_task(task_config, args, sim_kwargs, transcripts=None):
+    scene_id = task_config['scene']['scene_id']
+    task = Simulation.from_config(task_config, get_result_dir(args), **sim_kwargs)
+    if args.phase == 'eval':
+        # evaluation on the saved transcript
+        res = task.rejudge(load_transcript(scene_id, transcripts))
     else:
         # simulation and evaluation
         res = task.run()
-    
     return scene_id, res
 
 
+async def process_task_async(task_config, args, sim_kwargs, transcripts=None):
+    scene_id = task_config['scene']['scene_id']
+    task = AsyncSimulation.from_config(task_config, get_result_dir(args), **sim_kwargs)
+    if args.phase == 'eval':
+        # evaluation on the saved transcript
+        res = await task.rejudge(load_transcript(scene_id, transcripts))
+    else:
+        # simulation and evaluation
+        res = await task.run()
+    return scene_id, res
+
+
+def log_scene(scene_id, res, logger):
+    if res["info_metrics"]:
+        logger.info('Scene {} | goal-self: {} goal-others: {} goal-judge: {} | info: {}'.format(scene_id, round(res["goal_metrics"]["self"],4), 
+                    round(res["goal_metrics"]["others"],4), {judge_name: round(res["goal_metrics"][judge_name],4) for judge_name in res["goal_metrics"] if judge_name.startswith("judge")}, 
+                    round(res["info_metrics"]["avg"],4)))
+    else:
+        logger.info('Scene {} | goal-self: {} goal-others: {} goal-judge: {} | info: {}'.format(scene_id, round(res["goal_metrics"]["self"],4), 
+                    round(res["goal_metrics"]["others"],4), {judge_name: round(res["goal_metrics"][judge_name],4) for judge_name in res["goal_metrics"] if judge_name.startswith("judge")}, 
+                    "NONE"))
+
+
+def report_results(aggregator, logger):
+    """log the averages over scenes and over templates"""
+    # average the results of all the scenarios
+    res = aggregator.scene_res()
+    logger.info('===== Results of Scenarios =====')
+    logger.info('the average result of goal completion at self dim: {}'.format(res['goal_self_score']))
+    logger.info('the average result of goal completion at others dim: {}'.format(res['goal_others_score']))
+    logger.info('the average result of goal completion at judge dim: {}'.format(res['goal_judge_score']))
+    logger.info('the average result of info reasoning: {}'.format(res['info_score']))
+    
+    logger.info('===== Results of Templates =====')
+    logger.info('# of templates: {}'.format(len(aggregator.template_stats)))
+    res = aggregator.tmpl_res()
+    logger.info('the average result of goal completion at self dim: mean: {} std: {}'.format(res['goal_self_score'],res['goal_self_std']))
+    logger.info('the average result of goal completion at others dim: mean: {} std: {}'.format(res['goal_others_score'],res['goal_others_std']))
+    logger.info('the average result of goal completion at judge dim: mean: {} std: {}'.format(res['goal_judge_score'], res['goal_judge_std']))   
+    logger.info('the average result of info reasoning: mean: {} std: {}'.format(res['info_score'], res['info_score_std']))
+    # free-text fallbacks mean that the endpoint ignores max_tokens or logprobs, or answers off the choices
+    for role, counts in aggregator.choice_fallbacks.items():
+        log = logger.warning if counts['fallbacks'] else logger.info
+        log('choice scoring [{}] interviews: {} free-text fallbacks: {}'.format(role, counts['requests'], counts['fallbacks']))
+
+
+def run_tasks(configs, args, sim_kwargs, scheduler, aggregator, transcripts=None):
+    """run scenes on a thread pool, dispatching the longest estimated scene whenever a worker is free"""
+    all_res = {}
+    running = {}
+
+    def submit(executor):
+        task_config, features = scheduler.pop()
+        future = executor.submit(process_task, task_config, args, sim_kwargs, transcripts)
+        running[future] = (task_config['scene']['scene_id'], features, time.perf_counter())
+
+    with ThreadPoolExecutor(max_workers=args.task_workers) as executor, tqdm(total=len(configs), desc="simulating") as pbar:
+        while len(running) < args.task_workers and len(scheduler):
+            submit(executor)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                scene_id, features, start = running.pop(future)
+                pbar.update(1)
+                try:
+                    scene_id, res = future.result()
+                    all_res[scene_id] = res
+                    log_scene(scene_id, res, logger)
+                    aggregator.add(scene_id, res)
+                    aggregator.maybe_write()
+                    scheduler.observe(features, time.perf_counter() - start)
+                except Exception as e:
+                    logger.error(f"Error in simulating scene {scene_id}: {e}")
+                if len(scheduler):
+                    submit(executor)
+    return all_res
+
+
+async def run_tasks_async(configs, args, sim_kwargs, scheduler, aggregator, transcripts=None):
+    """run scenes as coroutines on a single event loop, at most task_workers at a time,
+    dispatching the longest estimated scene whenever one finishes"""
+    all_res = {}
+    running = {}
+
+    def submit():
+        task_config, features = scheduler.pop()
+        task = asyncio.ensure_future(process_task_async(task_config, args, sim_kwargs, transcripts))
+        running[task] = (task_config['scene']['scene_id'], features, time.perf_counter())
+
+    try:
+        with tqdm(total=len(configs), desc="simulating") as pbar:
+            while len(running) < args.task_workers and len(scheduler):
+                submit()
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    scene_id, features, start = running.pop(task)
+                    pbar.update(1)
+                    try:
+                        scene_id, res = task.result()
+                        all_res[scene_id] = res
+                        log_scene(scene_id, res, logger)
+                        aggregator.add(scene_id, res)
+                        aggregator.maybe_write()
+                        scheduler.observe(features, time.perf_counter() - start)
+                    except Exception as e:
+                        logger.error(f"Error in simulating scene {scene_id}: {e}")
+                    if len(scheduler):
+                        submit()
+    finally:
+        for task in running:
+            task.cancel()
+        await close_async_clients()
+    return all_res
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--pattern', type=str, default='homo', help='interaction between homogeneous or heterogeneous agents, choose from [homo, heter]')
     parser.add_argument('--input_path', type=str, default="./data/final_data.jsonl", help='path of the file of scenario setting')
-    parser.add_argument('--config_dir', type=str, default="./configs/llama2_13b/", help='dir of generated cofig')
+    parser.add_argument('--config_dir', type=str, default="./configs/llama2_13b/", help='dir of generated cofig, written only with --write_yaml')
+    parser.add_argument('--write_yaml', action='store_true', help='write the yaml config of each scene to config_dir')
+    parser.add_argument('--config_bundle', type=str, default=None, help='path of a single jsonl file caching the task configs, reused when built from the same inputs and arguments')
     parser.add_argument('--output_dir', type=str, default="./output/llama2_13b/", help='dir of output')
     parser.add_argument('--prompt_template_path', type=str, default="/remote-home/share/xymou_share/socialbench/SENSE/configs/prompt_template_hide.json", help='the path of prompt template for social agents and judge agents')
     parser.add_argument('--max_round', type=int, default=15, help='the max round of dialog, if set to 0, use automatic 10*len(agents)')
     parser.add_argument('--speaker_selection_method', type=str, default='random', help='selection method of slecting the next speaker')
     parser.add_argument('--allow_repeat_speaker', type=bool, default=False, help='whether repeated speakers are allowed. must set False when only 2 agents are involved')
     parser.add_argument('--model', type=str, default="Llama-2-13b-chat-hf", help='the driven models of agents')
-    parser.add_argument('--base_url', type=str, default="http://0.0.0.0:8000/v1", help='url of API interface')
+    parser.add_argument('--base_url', type=str, default="http://0.0.0.0:8000/v1", help='url of API interface, or comma-separated urls of the replicas of a model')
     parser.add_argument('--api_key', type=str, default="1234", help='key of API interface')
     parser.add_argument('--api_type', type=str, default="openai", help='type of API interface')
     parser.add_argument('--temperature', type=float, default=0)
     parser.add_argument('--max_tokens', type=int, default=128)
     parser.add_argument('--judge_config', type=str, default="./configs/judge_config.json", help='the paths of judge configs')    
     parser.add_argument('--option_mark', type=str, default='upper', help='option mark for multiple-choice questions in info reasoning evaluation')   
-    parser.add_argument('--task_workers', type=int, default=4, help='num of parallel workers for simulation')
+    parser.add_argument('--trunc_mode', type=str, default='client', help='truncation of dialog turns at the first newline, client: after generation; stop: as a server-side stop sequence, choose from [client, stop]')
+    parser.add_argument('--task_workers', type=int, default=4, help='num of parallel workers for simulation, or num of concurrent scenes with the async engine')
+    parser.add_argument('--engine', type=str, default='thread', help='execution engine of scenes, choose from [thread, async]')
+    parser.add_argument('--pool_max_connections', type=int, default=100, help='max num of connections of the http client shared per endpoint')
+    parser.add_argument('--pool_max_keepalive', type=int, default=20, help='max num of idle keep-alive connections of the http client shared per endpoint')
+    parser.add_argument('--pool_keepalive_expiry', type=float, default=30, help='seconds before closing an idle keep-alive connection')
+    parser.add_argument('--adaptive_limits', action='store_true', help='adapt the max num of in-flight requests per endpoint, growing while latency is healthy and backing off on 429s and timeouts')
+    parser.add_argument('--initial_concurrency', type=int, default=4, help='initial max num of in-flight requests per endpoint with --adaptive_limits')
+    parser.add_argument('--max_concurrency', type=int, default=64, help='upper bound of the max num of in-flight requests per endpoint with --adaptive_limits, which are also bounded by task_workers x eval_concurrency')
+    parser.add_argument('--rate_limit', type=float, default=0, help='max num of requests per second per endpoint with --adaptive_limits, unlimited if 0')
+    parser.add_argument('--latency_target', type=float, default=0, help='latency in seconds under which a request is healthy with --adaptive_limits, if 0, twice the baseline latency of the endpoint')
+    parser.add_argument('--replica_routing', type=str, default='sticky', help='routing of requests over the replicas of a model, sticky: to the replica of the scene unless it is overloaded; least_outstanding: to the replica with the fewest in-flight requests, choose from [sticky, least_outstanding]')
+    parser.add_argument('--replica_max_errors', type=int, default=3, help='num of consecutive errors after which a replica is evicted')
+    parser.add_argument('--replica_slow_factor', type=float, default=3.0, help='a replica is evicted once its latency exceeds this factor times the median latency of the other replicas')
+    parser.add_argument('--replica_cooldown', type=float, default=30, help='seconds before an evicted replica is tried again')
+    parser.add_argument('--num_shards', type=int, default=1, help='num of shards the scenes are split into, by whole templates, for runs on several processes or nodes')
+    parser.add_argument('--shard_id', type=int, default=0, help='index of the shard to run, from 0 to num_shards-1')
+    parser.add_argument('--early_stop', type=str, default='', help='comma-separated triggers ending a dialog before max_round, choose from [farewell, repetition, classifier], disabled if empty')
+    parser.add_argument('--batch_judge', action='store_true', help='ask each judge about all goals of an agent in one request answered as a json array, falling back to one request per goal')
+    parser.add_argument('--judge_ensemble', type=str, default='all', help='judges queried per question in the order of judge_cost, all: every judge; majority: until the majority is decided; cascade: until a verdict without hedging, choose from [all, majority, cascade]')
+    parser.add_argument('--choice_scoring', type=str, default='none', help='answer Yes/No and multiple-choice interviews with a single token and record the distribution over the choices, logprobs: from the top logprobs; guided: with vLLM guided choice, choose from [none, logprobs, guided]')
+    parser.add_argument('--batch_info', action='store_true', help='ask each agent all of its info questions in one request answered as a json array, falling back to one request per question')
+    parser.add_argument('--prefix_warmup', action='store_true', help='send the first interview of each agent alone and the others after it returns, so that they hit the prefix cache of the shared transcript')
+    parser.add_argument('--prefix_cache_metrics', action='store_true', help='scrape the prefix cache counters of vLLM endpoints from /metrics at the start and end of the run')
+    parser.add_argument('--summary_interval', type=float, default=60, help='seconds between writes of the partial scene and template statistics to summary.json in the result dir, only written at the end if 0')
+    parser.add_argument('--results_table', type=str, default=None, help='path of a long-format table of the scene results for leaderboard.py, parquet (requires pyarrow) or .npz, not written if not given')
+    parser.add_argument('--result_store', type=str, default='json', help='store of the scene results, json: one file per scene in the result dir; sqlite: rows of a single indexed file, choose from [json, sqlite]')
+    parser.add_argument('--result_db', type=str, default=None, help='path of the sqlite file of --result_store sqlite, which may hold the results of several runs, default to output_dir/results.db')
+    parser.add_argument('--bootstrap', type=int, default=0, help='num of bootstrap replicates of the 95%% confidence intervals of the template-level scores logged at the end of the run, disabled if 0')
+    parser.add_argument('--phase', type=str, default='all', help='all: simulate and evaluate; eval: only evaluate the transcripts saved in output_dir, choose from [all, eval]')
+    parser.add_argument('--judge_tag', type=str, default=None, help='sub-dir of output_dir for the results of the eval phase, default to eval_<judge config name>')
+    parser.add_argument('--eval_concurrency', type=int, default=4, help='max num of in-flight interview requests per endpoint when evaluating a scene')
+    parser.add_argument('--cache_path', type=str, default=None, help='path of the sqlite cache of llm responses, disabled if not given')
+    parser.add_argument('--cache_roles', type=str, default='judge', help='comma-separated roles whose responses are cached, choose from [dialog, interview, judge]')
+    parser.add_argument('--cache_max_mb', type=float, default=1024, help='max size of the response cache in MB before evicting least recently used entries')
+    parser.add_argument('--no_journal', action='store_true', help='do not journal finished turns and answers for resuming interrupted scenes')
 
     args = parser.parse_args()
+    if args.phase == 'eval' and args.judge_tag is None:
+        args.judge_tag = 'eval_' + os.path.splitext(os.path.basename(args.judge_config))[0]
+
+    if not 0 <= args.shard_id < args.num_shards:
+        raise ValueError("shard_id must be in [0, num_shards)")
 
     global logger
-    logger = setup_logger('Evaluation', args.output_dir, 0)
+    logger = setup_logger('Evaluation', get_result_dir(args), 0, filename='log{}.txt'.format(shard_suffix(args)))
     if args.pattern =='homo':
         logger.info('Evaluating model: {}'.format(args.model))
+    if args.phase == 'eval':
+        logger.info('Re-judging saved transcripts under tag: {}'.format(args.judge_tag))
+    elif args.phase != 'all':
+        raise NotImplementedError("unsupported phase: {}".format(args.phase))
     # generate configs for simulation
     if not os.path.exists(args.prompt_template_path):
         raise Exception("Please provide json of prompt templates.")
     prompt_template = json.load(open(args.prompt_template_path,'r'))
+    build_kwargs = dict(
+        prompt_template=prompt_template["prompt_template"],
+        judge_prompt_template=prompt_template["judge_prompt_template"],
+        max_round=args.max_round,
+        speaker_selection_method=args.speaker_selection_method,
+        allow_repeat_speaker=args.allow_repeat_speaker,
+        temperature=args.temperature,
+        max_tokens=args.max_tokens,
+        option_mark=args.option_mark,
+        trunc_mode=args.trunc_mode,
+        num_shards=args.num_shards,
+        shard_id=args.shard_id
+    )
     if args.pattern =='homo':
-        generate_batch_config(
-            input_path=args.input_path,
-            output_dir=args.config_dir,
-            prompt_template=prompt_template["prompt_template"],
-            judge_prompt_template=prompt_template["judge_prompt_template"],
-            max_round=args.max_round,
-            speaker_selection_method=args.speaker_selection_method,
-            allow_repeat_speaker=args.allow_repeat_speaker,
-            model=args.model,
-            base_url=args.base_url,
-            api_key=args.api_key,
-            api_type=args.api_type,
-            temperature=args.temperature,
-            max_tokens=args.max_tokens,
-            judge_config=args.judge_config,
-            option_mark=args.option_mark
-        )    
-    elif args.pattern =='heter':
-        generate_heter_batch_config(
-            input_path=args.input_path,
-            output_dir=args.config_dir,
-            prompt_template=prompt_template["prompt_template"],
-            judge_prompt_template=prompt_template["judge_prompt_template"],
-            max_round=args.max_round,
-            speaker_selection_method=args.speaker_selection_method,
-            allow_repeat_speaker=args.allow_repeat_speaker,
-            temperature=args.temperature,
-            max_tokens=args.max_tokens,
-            judge_config=args.judge_config,
-            option_mark=args.option_mark
-        )     
-    else:
+        build_kwargs["agent_llm"] = {"model":args.model, "base_url":args.base_url, "api_key":args.api_key, "api_type":args.api_type}
+    elif args.pattern !='heter':
         raise NotImplementedError("unsupported pattern: {}".format(args.pattern))    
 
+    # build configs for simulation in memory, reusing the bundle if built from the same inputs
+    configs = None
+    if args.config_bundle:
+        config_hash = bundle_key(args.input_path, args.judge_config, **build_kwargs)
+        configs = load_task_bundle(args.config_bundle, config_hash)
+        if configs is not None:
+            logger.info('Loaded task configs from bundle: {}'.format(args.config_bundle))
+    if configs is None:
+        configs = build_batch_config(input_path=args.input_path, judge_config=args.judge_config, **build_kwargs)
+        if args.config_bundle:
+            save_task_bundle(configs, args.config_bundle, config_hash)
+    if args.write_yaml:
+        write_batch_config(configs, args.config_dir)
+
     # simulation
-    all_res = {}
-    configs = [f for f in os.listdir(args.config_dir) if os.path.isfile(os.path.join(args.config_dir, f))]
     logger.info("***** Runing Simulation and Evaluation *****")
     logger.info("  Num tasks = %d", len(configs))
+    if args.num_shards > 1:
+        logger.info("  Shard = %d of %d", args.shard_id, args.num_shards)
 
-    with ThreadPoolExecutor(max_workers=args.task_workers) as executor:
-        futures = {executor.submit(process_task, config_file, args): config_file for config_file in configs}
-
-        for future in tqdm(as_completed(futures), total=len(configs), desc="simulating"):
-            config_file = futures[future]
-            try:
-                scene_id, res = future.result()
-                all_res[scene_id] = res
-                if res["info_metrics"]:
-                    logger.info('Scene {} | goal-self: {} goal-others: {} goal-judge: {} | info: {}'.format(scene_id, round(res["goal_metrics"]["self"],4), 
-                                round(res["goal_metrics"]["others"],4), {judge_name: round(res["goal_metrics"][judge_name],4) for judge_name in res["goal_metrics"] if judge_name.startswith("judge")}, 
-                                round(res["info_metrics"]["avg"],4)))
-                else:
-                    logger.info('Scene {} | goal-self: {} goal-others: {} goal-judge: {} | info: {}'.format(scene_id, round(res["goal_metrics"]["self"],4), 
-                                round(res["goal_metrics"]["others"],4), {judge_name: round(res["goal_metrics"][judge_name],4) for judge_name in res["goal_metrics"] if judge_name.startswith("judge")}, 
-                                "NONE"))
-            except Exception as e:
-                logger.error(f"Error in simulating {config_file}: {e}")
+    CLIENTS.configure(args.pool_max_connections, args.pool_max_keepalive, args.pool_keepalive_expiry, logger,
+                      routing=args.replica_routing, max_errors=args.replica_max_errors,
+                      slow_factor=args.replica_slow_factor, cooldown=args.replica_cooldown)
+    LIMITS.configure(args.adaptive_limits, logger, rate=args.rate_limit, initial_limit=args.initial_concurrency,
+                     max_limit=args.max_concurrency, latency_target=args.latency_target)
+    # models served by several replicas are identified by their first url
+    models = {tuple(replicas(agent["llm"]["base_url"])) for config in configs for agent in config["agents"] + config["judge_agents"]}
+    endpoints = sorted({url for urls in models for url in urls})
+    for urls in sorted(models):
+        replica_set = CLIENTS.replica_set(list(urls))
+        if replica_set is not None:
+            replica_set.check_health()
+            logger.info('model at {} served by {} replicas, routing: {}'.format(urls[0], len(urls), args.replica_routing))
+    if args.adaptive_limits:
+        # the limit only gates the requests of the scenes in flight, so the requests to an
+        # endpoint never exceed task_workers x eval_concurrency, whatever the limit
+        for endpoint in sorted({urls[0] for urls in models}):
+            LIMITS.get(endpoint)
+            logger.info('endpoint {} initial concurrency limit: {} max: {} bounded by task_workers x eval_concurrency: {} rate limit: {}'.format(
+                endpoint, args.initial_concurrency, args.max_concurrency, args.task_workers * args.eval_concurrency, args.rate_limit or 'NONE'))
+    cache = ResponseCache(args.cache_path, args.cache_max_mb) if args.cache_path else None
+    recorder = LLMCallRecorder()
+    probe = PrefixCacheProbe(endpoints) if args.prefix_cache_metrics else None
+    if probe is not None:
+        probe.begin()
+    sim_kwargs = {
+        "eval_concurrency": args.eval_concurrency,
+        "cache": cache,
+        "cache_roles": args.cache_roles.split(',') if args.cache_roles else [],
+        "journal": not args.no_journal,
+        "recorder": recorder,
+        "batch_judge": args.batch_judge,
+        "judge_ensemble": args.judge_ensemble,
+        "choice_scoring": args.choice_scoring,
+        "batch_info": args.batch_info,
+        "prefix_warmup": args.prefix_warmup,
+        "early_stop": tuple(args.early_stop.split(',')) if args.early_stop else None,
+    }
+    # scene and template statistics updated as the scenes finish, written to the summary file periodically
+    aggregator = MetricAggregator({config["scene"]["scene_id"]: config["scene"]["template_idx"] for config in configs},
+                                  os.path.join(get_result_dir(args), 'summary{}.json'.format(shard_suffix(args))), args.summary_interval)
+    # resume from the metrics of the scenes saved by previous runs, read at once without their transcripts
+    result_store = open_result_store(args.result_store, args.output_dir, args.judge_tag, run_model(args), args.pattern, args.result_db)
+    transcripts = open_result_store(args.result_store, args.output_dir, None, run_model(args), args.pattern, args.result_db) if args.phase == 'eval' else None
+    sim_kwargs["result_store"] = result_store
+    all_res = result_store.metrics([config["scene"]["scene_id"] for config in configs])
+    for scene_id, res in all_res.items():
+        log_scene(scene_id, res, logger)
+        aggregator.add(scene_id, res)
+    if all_res:
+        logger.info('Resumed {} finished scenes from the result store'.format(len(all_res)))
+    pending = [config for config in configs if config["scene"]["scene_id"] not in all_res]
+    # dispatch the longest scenes first, so they do not straggle at the end of the run
+    scheduler = SceneScheduler(pending, SceneCostModel(simulate=args.phase != 'eval'))
+    scheduler.log_plan(logger)
+    if args.engine == 'async':
+        all_res.update(asyncio.run(run_tasks_async(pending, args, sim_kwargs, scheduler, aggregator, transcripts)))
+    elif args.engine == 'thread':
+        all_res.update(run_tasks(pending, args, sim_kwargs, scheduler, aggregator, transcripts))
+    else:
+        raise NotImplementedError("unsupported engine: {}".format(args.engine))
+    result_store.close()
+    if transcripts is not None:
+        transcripts.close()
+    scheduler.log_stats(logger)
+    if args.early_stop:
+        ends = [res["termination"] for res in all_res.values() if "termination" in res]
+        logger.info('dialog ends: {} rounds saved: {}'.format(
+            dict(collections.Counter(end["reason"] for end in ends)), sum(end["rounds_saved"] for end in ends)))
+    if cache is not None:
+        cache.log_stats(logger)
+        cache.close()
+    if args.trunc_mode == 'stop':
+        STOP_STATS.log_stats(logger)
+    recorder.write(get_result_dir(args), logger, name='llm_metrics{}'.format(shard_suffix(args)))
+    if probe is not None:
+        probe.log_stats(logger)
+    CLIENTS.log_stats(logger)
+    CLIENTS.close()
+    if args.adaptive_limits:
+        LIMITS.log_stats(logger)
+
+    aggregator.write(final=True)
+    report_results(aggregator, logger)
+    if args.bootstrap > 0 and all_res:
+        logger.info('===== Bootstrap CIs of Templates ({} replicates, stratified by template) ====='.format(args.bootstrap))
+        for metric, ci in bootstrap_report(all_res, aggregator.templates, args.bootstrap).items():
+            logger.info('{}: mean: {} 95% CI: [{}, {}] scenes: {}'.format(
+                metric, round(ci['score'], 4), round(ci['low'], 4), round(ci['high'], 4), ci['scenes']))
+    if args.results_table:
+        write_table(results_table(run_model(args), all_res, aggregator.templates), args.results_table)
+        logger.info('Results table written to {}'.format(args.results_table))
 
-    # average the results of all the scenarios
-    goal_self_score = [all_res[key]['goal_metrics']['self'] for key in all_res]
-    goal_others_score = [all_res[key]['goal_metrics']['others'] for key in all_res]
-    judges = [name for name in all_res[list(all_res.keys())[0]]['goal_metrics'] if name.startswith('judge')]
-    judge_score_dict = {}
-    for judge in judges:
-        goal_judge_score = [all_res[key]['goal_metrics'][judge] for key in all_res]
-        goal_judge_score = np.mean(goal_judge_score)
-        judge_score_dict[judge] = round(goal_judge_score,4)
-    info_score = [all_res[key]['info_metrics']['avg'] for key in all_res if all_res[key]['info_metrics']]
-    goal_self_score = np.mean(goal_self_score)
-    goal_others_score = np.mean(goal_others_score)
-    info_score = np.mean(info_score)
-    
-    logger.info('===== Results of Scenarios =====')
-    logger.info('the average result of goal completion at self dim: {}'.format(round(goal_self_score,4)))
-    logger.info('the average result of goal completion at others dim: {}'.format(round(goal_others_score,4)))
-    logger.info('the average result of goal completion at judge dim: {}'.format(judge_score_dict))
-    logger.info('the average result of info reasoning: {}'.format(round(info_score,4)))
-    
-    logger.info('===== Results of Templates =====')
-    res = calculate_tmpl_res(all_res, args.input_path)
-    logger.info('the average result of goal completion at self dim: mean: {} std: {}'.format(res['goal_self_score'],res['goal_self_std']))
-    logger.info('the average result of goal completion at others dim: mean: {} std: {}'.format(res['goal_others_score'],res['goal_others_std']))
-    logger.info('the average result of goal completion at judge dim: mean: {} std: {}'.format(res['goal_judge_score'], res['goal_judge_std']))   
-    logger.info('the average result of info reasoning: mean: {} std: {}'.format(res['info_score'], res['info_score_std']))
-    
-    
 
 if __name__=="__main__":
     main()
@@ -3,36 +3,127 @@ Base interface of simulation for a single scene
 """
 from typing import List
 import autogen
-from autogen.agentchat.contrib.capabilities import transform_messages
+import openai
 from autogen.agentchat.contrib.capabilities.transforms import TextMessageContentName
-from utils.model_utils import TextMessageTruncate
+from utils.model_utils import TextMessageTruncate, IncrementalTransformMessages
 from pydantic import BaseModel
-from initialization import load_scene, load_agent, load_judge_agent, load_groupchat, prepare_task_config, update_agent_llm_config
+from initialization import load_scene, load_agent, load_judge_agent, load_groupchat, read_task_config, compile_task_config, update_agent_llm_config, set_stop_sequences
 from metric import *
+import collections
+import os
 import random
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from utils.eval_scheduler import EvalScheduler
+from utils.journal import SceneJournal
+from utils.rate_limit import LIMITS
+from utils.routing import route_task_config
+from utils.termination import TerminationPolicy
+from utils.batch_eval import batch_question, parse_json_list, verdict_text
+from utils.judge_ensemble import JudgeEnsemble
+from utils.choice_scoring import YES_NO, CHOICE_INSTRUCTION, option_marks, scoring_config, choice_request, choice_distribution, format_choice
+
+# instruction of the batched questions to judges
+JUDGE_BATCH_INSTRUCTION = "Please answer each of the following questions with Yes or No."
+
+# instruction of the info questions formatted by question_with_options, and of the batched ones
+INFO_INSTRUCTION = "Please answer the question and only output your choice.\n"
+INFO_BATCH_INSTRUCTION = "Please answer each of the following questions and only output your choices."
+
+# question to the classifier of early termination
+END_QUESTION = "Has the conversation come to an end, e.g. the characters have said goodbye or have nothing more to discuss? Please only answer Yes or No."
+
 
 class Simulation:
-    def __init__(self, scene, agents, judge_agents, group_chat, chat_manager, output_dir):
+    def __init__(self, scene, agents, judge_agents, group_chat, chat_manager, output_dir, eval_concurrency=4,
+                 cache=None, cache_roles=(), journal=False, recorder=None, termination=None, batch_judge=False,
+                 judge_ensemble='all', judge_order=None, choice_scoring='none', batch_info=False, prefix_warmup=False,
+                 result_store=None):
         self.scene = scene
         self.agents = agents
         self.judge_agents = judge_agents
         self.group_chat = group_chat
         self.chat_manager = chat_manager
         self.output_dir = output_dir
+        # store of the results, default to a json file per scene in output_dir
+        self.result_store = result_store
+        # max number of in-flight interview requests per endpoint
+        self.eval_concurrency = eval_concurrency
+        # interviews of an agent sent back to back once the first one has cached their prefix
+        self.prefix_warmup = prefix_warmup
+        # persistent response cache, used by the roles among dialog/interview/judge
+        self.cache = cache
+        self.cache_roles = cache_roles
+
+        # instrumentation of llm calls, labelled by the scene and its current phase
+        self.recorder = recorder
+        self.labels = {"scene_id": scene['scene_id'], "phase": 'dialog'}
 
         self.agent_dict = {}
         for agent in self.agents:
             self.agent_dict[agent.name] = agent
+            if recorder is not None:
+                recorder.wrap_agent(agent, self.labels, 'agent')
+            # gate outside the instrumentation, so recorded latency excludes the wait for a slot
+            LIMITS.wrap_agent(agent)
  
         for agent in self.judge_agents:
             # with 'judge_' prefix in its name
             self.agent_dict[agent.name] = agent
+            agent.client_cache = self.role_cache('judge', [agent])
+            if recorder is not None:
+                recorder.wrap_agent(agent, self.labels, 'judge')
+            LIMITS.wrap_agent(agent)
+
+        # one request per judge per agent for all of its goals, instead of one per goal
+        self.batch_judge = batch_judge
+        # one request per agent for all of its info questions, instead of one per question
+        self.batch_info = batch_info
+        # judges queried in cost order, possibly stopping once the verdict is decided
+        self.ensemble = JudgeEnsemble(judge_ensemble, judge_order, len(judge_agents))
+
+        # single-token answers of Yes/No and multiple-choice questions, with their distributions
+        self.choice_scoring = choice_scoring
+        self.choice_dists = {}
+        self.scoring_clients = {}
+        self.scoring_roles = {}
+        # role -> num of scored interviews and of those answered in free text instead
+        self.choice_counts = collections.defaultdict(collections.Counter)
+        self.choice_lock = threading.Lock()
+        if choice_scoring != 'none':
+            for agent in self.agents:
+                self.scoring_clients[agent.name] = self.load_scoring_client(agent, 'agent')
+                self.scoring_roles[agent.name] = 'agent'
+            for agent in self.judge_agents:
+                self.scoring_clients[agent.name] = self.load_scoring_client(agent, 'judge')
+                self.scoring_roles[agent.name] = 'judge'
+
+        # early termination of the dialog, and how it ended
+        self.termination = termination
+        if termination is not None:
+            termination.classifier = self.classify_ended
+        self.dialog_end = None
+
+        # journal of finished turns and answers for resuming the scene
+        self.journal = None
+        self.replaying = False
+        if journal:
+            self.journal = SceneJournal(os.path.join(output_dir, 'journal', '{}.jsonl'.format(scene['scene_id'])))
+            for key, dist in self.journal.answers.items():
+                if key[0] == 'dist':
+                    self.choice_dists[key[1:]] = dist
+            for agent in self.agents:
+                agent.register_hook("process_message_before_send", self.record_turn)
             
     @classmethod
-    def from_task(cls, tasks_path: str, output_dir: str):
-        task_config = prepare_task_config(tasks_path)
+    def from_task(cls, tasks_path: str, output_dir: str, **kwargs):
+        # the llm configs are compiled once, by from_config
+        return cls.from_config(read_task_config(tasks_path), output_dir, **kwargs)
+
+    @classmethod
+    def from_config(cls, task_config: dict, output_dir: str, **kwargs):
+        """build the simulation from a task config built in memory"""
+        task_config = compile_task_config(route_task_config(task_config))
         # Build the scene
         scene = load_scene(task_config["scene"])
         # Build the agents
@@ -49,28 +140,127 @@ class Simulation:
         # Build the group chat
         name_transform = TextMessageContentName(position="start", format_string="{name}: ")
         trunc_transform = TextMessageTruncate(trunc_symbol='\n')
-        context_handling = transform_messages.TransformMessages(transforms=[name_transform, trunc_transform])
+        context_handling = IncrementalTransformMessages(transforms=[name_transform, trunc_transform])
         for agent in agents:
             context_handling.add_to_agent(agent)
         for agent in judge_agents:
             context_handling.add_to_agent(agent)
-        group_chat, chat_manager = load_groupchat(agents, task_config["groupchat"])
+        # judges in the cost order of the judge config, from the cheapest
+        judge_costs = [agent_config.get("cost", 0) for agent_config in task_config["judge_agents"]]
+        kwargs.setdefault("judge_order", sorted(range(len(judge_costs)), key=lambda k: judge_costs[k]))
+        early_stop = kwargs.pop("early_stop", None)
+        termination = TerminationPolicy(early_stop) if early_stop else None
+        group_chat, chat_manager = load_groupchat(agents, task_config["groupchat"], termination)
 
-        return cls(scene, agents, judge_agents, group_chat, chat_manager, output_dir)
+        return cls(scene, agents, judge_agents, group_chat, chat_manager, output_dir, termination=termination, **kwargs)
 
     def run(self,):
         # simulation
-        start_agent = random.choice(self.agents)
-        self.groupchat_result = start_agent.initiate_chat(
-            self.chat_manager, message="Hi, there!"
-        )
+        self.simulate()
         # reset the temperature for evaluation
+        self.prepare_eval()
+        # evaluation
+        self.evaluate()
+        return self.save()
+
+    def rejudge(self, chat_history):
+        """ evaluate a saved transcript without re-running the simulation """
+        self.chat_history = chat_history
+        self.prepare_eval()
+        self.evaluate()
+        return self.save()
+
+    def simulate(self):
+        """ run the group chat of the scene, resuming from the journaled turns if any """
+        turns = self.journal.turns if self.journal is not None else []
+        stopped = self.journal.stop if self.journal is not None else None
+        cache = self.role_cache('dialog', self.agents)
+        if not turns:
+            start_agent = random.choice(self.agents)
+            self.groupchat_result = start_agent.initiate_chat(
+                self.chat_manager, message="Hi, there!", cache=cache
+            )
+        elif len(turns) < self.group_chat.max_round and stopped is None:
+            start_agent = self.agent_dict[turns[0][0]]
+            self.resume_chat(turns, cache)
+        else:
+            # the dialog was finished before the interruption
+            self.chat_history = self.view(turns, turns[0][0])
+            self.finish_dialog(stopped)
+            return
+        self.chat_history = start_agent.chat_messages[self.chat_manager]
+        self.finish_dialog(self.termination.reason if self.termination is not None else None)
+
+    def finish_dialog(self, reason):
+        """ record why the dialog ended and how many rounds were saved by ending it early """
+        if self.termination is None:
+            return
+        rounds_saved = max(self.group_chat.max_round - len(self.chat_history), 0)
+        if reason is None or rounds_saved == 0:
+            reason = 'max_round'
+        elif self.journal is not None and self.journal.stop is None:
+            self.journal.record_stop(reason)
+        self.dialog_end = {"reason": reason, "turns": len(self.chat_history), "rounds_saved": rounds_saved}
+
+    def classify_ended(self, turns):
+        """ ask the first judge whether the dialog has ended """
+        judge = self.judge_agents[0]
+        return 'Yes' in self.interview_agent(judge.name, END_QUESTION, self.view(turns, judge.name))
+
+    def resume_chat(self, turns, cache):
+        """ restore the journaled turns into the agents and continue the group chat from the last one """
         for agent in self.agents:
+            agent.chat_messages[self.chat_manager] = self.view(turns[:-1], agent.name)
+        if self.termination is not None:
+            for name, content in turns[:-1]:
+                self.termination.observe(name, content)
+        self.group_chat.messages = [{"content": content, "role": "user", "name": name} for name, content in turns[:-1]]
+        # the last turn is sent again to restart the rounds, without journaling it twice
+        max_round = self.group_chat.max_round
+        self.group_chat.max_round = max_round - len(turns) + 1
+        self.replaying = True
+        name, content = turns[-1]
+        self.groupchat_result = self.agent_dict[name].initiate_chat(
+            self.chat_manager, message=content, clear_history=False, cache=cache
+        )
+        self.group_chat.max_round = max_round
+
+    def record_turn(self, sender, message, recipient, silent):
+        """ hook journaling the messages sent by agents to the group chat """
+        if recipient is self.chat_manager:
+            if self.replaying:
+                self.replaying = False
+            else:
+                self.journal.record_turn(sender.name, message if isinstance(message, str) else message.get("content"))
+        return message
+
+    @staticmethod
+    def view(turns, agent_name):
+        """ (name, content) turns of the group chat as seen by one of its agents """
+        return [{
+            "content": content,
+            "role": "assistant" if name == agent_name else "user",
+            "name": name,
+        } for name, content in turns]
+
+    def role_cache(self, role, agents):
+        """ the response cache shared by the agents in a role, or None if the role is not cached """
+        if self.cache is None or role not in self.cache_roles:
+            return None
+        endpoints = sorted(set(str(self.endpoint(agent.name)) for agent in agents))
+        return self.cache.view(role, ','.join(endpoints))
+
+    def prepare_eval(self):
+        """ switch the agents from the dialog to the interviews """
+        self.labels['phase'] = 'interview'
+        for agent in self.agents:
+            agent.client_cache = self.role_cache('interview', [agent])
+            # interview answers are not truncated
+            set_stop_sequences(agent, False)
             update_agent_llm_config(agent, 'temperature', self.judge_agents[0].llm_config['config_list'][0]['temperature'])
-        # evaluation
-        self.eval_goal()
-        self.eval_info()
-        # calculate metrics
+
+    def save(self):
+        """ calculate metrics and save the results """
         goal_metric = GoalMetric()
         info_metric = SingleChoiceMetric(self.scene['option_mark'])
         goal_res = goal_metric(self.goal_eval_res, self.judge_agents)
@@ -80,14 +270,27 @@ class Simulation:
             info_res = {}
         # save the results
         res = {
-            "chat_history":self.groupchat_result.chat_history,
+            "chat_history":self.chat_history,
             "goal_answer":self.goal_eval_res,
             "goal_metrics":goal_res,
             "info_answer":self.info_eval_res,
             "info_metrics":info_res
         }
-        with open(self.output_dir+'/'+str(self.scene['scene_id'])+'.json','w') as f:
-            json.dump(res, f)
+        if self.dialog_end is not None:
+            res["termination"] = self.dialog_end
+        if self.choice_scoring != 'none':
+            # distributions over the choices next to the answers, None for free-text answers
+            dists = collections.defaultdict(lambda: None, self.choice_dists)
+            res["goal_answer_dist"] = self.collect_goal_results(dists)
+            res["info_answer_dist"] = self.collect_info_results(dists)
+            res["choice_fallbacks"] = {role: dict(counts) for role, counts in self.choice_counts.items()}
+        if self.result_store is not None:
+            self.result_store.put(self.scene['scene_id'], res)
+        else:
+            with open(self.output_dir+'/'+str(self.scene['scene_id'])+'.json','w') as f:
+                json.dump(res, f)
+        if self.journal is not None:
+            self.journal.close(remove=True)
         return res
 
     
@@ -107,49 +310,228 @@ class Simulation:
         )
         return ans if type(ans)==str else ans['content']
 
-    def eval_goal(self):
-        """ evaluate goal completion """
-        # chat history of social interaction
-        chat_history = self.groupchat_result.chat_history
+    def load_scoring_client(self, agent, role):
+        """a client of the endpoint of an agent for single-token answers, as entries of
+        the llm config take precedence over the arguments of OpenAIWrapper.create"""
+        config = {k: v for k, v in agent.llm_config['config_list'][0].items() if k not in ('stop', 'model_client_cls')}
+        config.update(scoring_config(self.choice_scoring))
+        client = autogen.OpenAIWrapper(config_list=[config], cache_seed=None)
+        if self.recorder is not None:
+            self.recorder.wrap_client(client, config, agent.name, self.labels, role)
+        LIMITS.wrap_client(client, config['base_url'])
+        return client
+
+    def add_interview(self, scheduler, key, agent_name, question, chat_history, choices=None, callback=None):
+        """register an interview, scored over its choices with --choice_scoring"""
+        # the interviews of an agent share its system message and view of the chat history
+        if self.choice_scoring != 'none' and choices:
+            scheduler.add(key, self.endpoint(agent_name), self.choice_interview, key, agent_name, question, chat_history, choices,
+                          callback=callback, group=agent_name)
+        else:
+            scheduler.add(key, self.endpoint(agent_name), self.interview_agent, agent_name, question, chat_history,
+                          callback=callback, group=agent_name)
+
+    def choice_interview(self, key, agent_name, question, chat_history, choices):
+        """interview an agent with a single-token answer among the choices, falling back to
+        a free-text answer if the endpoint does not support it"""
+        agent = self.agent_dict[agent_name]
+        kind = 'goal' if choices == YES_NO else 'info'
+        messages = agent.process_all_messages_before_reply(chat_history+[{
+            "content":question + CHOICE_INSTRUCTION[kind],
+            "role":"user"
+        }])
+        try:
+            response = self.scoring_clients[agent_name].create(
+                messages=[{"content": agent.system_message, "role": "system"}] + messages,
+                cache=agent.client_cache, **choice_request(self.choice_scoring, choices))
+            dist = choice_distribution(response, choices)
+        except openai.BadRequestError:
+            dist = None
+        self.count_choice(agent_name, dist is None)
+        if dist is None:
+            return self.interview_agent(agent_name, question, chat_history)
+        self.record_dist(key, dist)
+        return format_choice(max(choices, key=dist.get), choices)
+
+    def count_choice(self, agent_name, fallback):
+        """count a scored interview, and whether it fell back to a free-text answer"""
+        with self.choice_lock:
+            counts = self.choice_counts[self.scoring_roles[agent_name]]
+            counts["requests"] += 1
+            counts["fallbacks"] += int(fallback)
+
+    def record_dist(self, key, dist):
+        self.choice_dists[key] = dist
+        if self.journal is not None:
+            self.journal.record_answer(('dist',) + key, dist)
+
+    def endpoint(self, agent_name):
+        """the endpoint serving an agent, used to bound concurrent requests"""
+        return self.agent_dict[agent_name].llm_config['config_list'][0].get('base_url')
+
+    def add_goal_requests(self, scheduler, chat_history):
+        """register the interviews for goal completion"""
+        for agent_name in self.scene['goal_question']:
+            judge_questions = []
+            for i in range(len(self.scene['goal_question'][agent_name])):
+                eval_question = self.scene['goal_question'][agent_name][i]['eval_questions']
+                for dim in eval_question: # self/other/judge
+                    for j in range(len(eval_question[dim])):
+                        ques = eval_question[dim][j]['question']
+                        if dim in ['self','others']:
+                            obj = eval_question[dim][j]['obj']
+                            self.add_interview(scheduler, ('goal', agent_name, i, dim, j), obj, ques, chat_history, YES_NO)
+                        elif dim == 'judge':
+                            judge_questions.append((i, j, ques))
+                        else:
+                            raise NotImplementedError("unsupported eval dimension: {}".format(dim))
+            if self.batch_judge:
+                self.add_judge_requests(scheduler, agent_name, judge_questions, chat_history)
+            else:
+                for question in judge_questions:
+                    self.add_judge_requests(scheduler, agent_name, [question], chat_history)
+
+    def add_judge_requests(self, scheduler, agent_name, questions, chat_history):
+        """register the judge interviews of (i, j, question) judge questions about the goals of
+        an agent, in waves of judges chosen by the ensemble from the verdicts of the previous
+        waves. Judges never queried get a None verdict"""
+        if not questions:
+            return
+        verdicts = [{} for _ in questions]
+        outstanding = [0]
+
+        def on_verdict(n, k, answer):
+            verdicts[n][k] = answer
+            outstanding[0] -= 1
+            if outstanding[0] == 0:
+                ask({n: self.ensemble.next(verdicts[n]) for n in range(len(questions))})
+
+        def ask(wave):
+            by_judge = collections.defaultdict(list)
+            for n, judges in wave.items():
+                for k in judges:
+                    by_judge[k].append(n)
+            if not by_judge:
+                for n, (i, j, _) in enumerate(questions):
+                    for k in range(len(self.judge_agents)):
+                        if k not in verdicts[n]:
+                            scheduler.set_result(('goal', agent_name, i, 'judge', j, k), None)
+                return
+            # counted before registering, as journaled answers complete right away
+            outstanding[0] += sum(len(ns) for ns in by_judge.values())
+            for k, ns in sorted(by_judge.items()):
+                if self.batch_judge:
+                    self.add_batch_judge_request(scheduler, agent_name, k, [(n,) + questions[n] for n in ns], on_verdict, chat_history)
+                else:
+                    for n in ns:
+                        self.add_single_judge_request(scheduler, agent_name, k, (n,) + questions[n], on_verdict, chat_history)
+
+        ask({n: self.ensemble.first() for n in range(len(questions))})
+
+    def add_single_judge_request(self, scheduler, agent_name, k, question, on_verdict, chat_history):
+        n, i, j, ques = question
+        self.add_interview(scheduler, ('goal', agent_name, i, 'judge', j, k), self.judge_agents[k].name, ques, chat_history, YES_NO,
+                           callback=lambda key, answer: on_verdict(n, k, answer))
+
+    def add_batch_judge_request(self, scheduler, agent_name, k, questions, on_verdict, chat_history):
+        """register one interview asking a judge about several goals of an agent, split back
+        into the answers of the single questions, or asked one by one if it cannot be parsed"""
+        obj = self.judge_agents[k]
+
+        def split(key, answer):
+            verdicts = parse_json_list(answer, len(questions))
+            for m, question in enumerate(questions):
+                n, i, j, _ = question
+                if verdicts is not None:
+                    verdict = verdict_text(verdicts[m])
+                    scheduler.set_result(('goal', agent_name, i, 'judge', j, k), verdict)
+                    on_verdict(n, k, verdict)
+                else:
+                    self.add_single_judge_request(scheduler, agent_name, k, question, on_verdict, chat_history)
+
+        ques = batch_question([q for _, _, _, q in questions], JUDGE_BATCH_INSTRUCTION, 'strings, "Yes" or "No"')
+        scheduler.add(('goal_batch', agent_name, k, ','.join(str(n) for n, _, _, _ in questions)), self.endpoint(obj.name),
+                      self.interview_agent, obj.name, ques, chat_history, callback=split, group=obj.name)
+
+    def collect_goal_results(self, results):
+        """assemble interview answers into the goal evaluation results"""
         goal_eval_res = {}
         for agent_name in self.scene['goal_question']:
             goal_eval_res[agent_name] = {}
             for i in range(len(self.scene['goal_question'][agent_name])):
                 data = self.scene['goal_question'][agent_name][i]
                 goal = data['goal']
-                eval_question =data['eval_questions']
-                for dim in eval_question: # self/other/judge
+                eval_question = data['eval_questions']
+                for dim in eval_question:
                     dim_res = []
                     for j in range(len(eval_question[dim])):
-                        if dim in ['self','others']:
-                            obj = eval_question[dim][j]['obj']
-                            ques = eval_question[dim][j]['question']
-                            ans = self.interview_agent(obj, ques, chat_history)
-                            dim_res.append(ans)
-                        elif dim =='judge':  
-                            ques = eval_question[dim][j]['question']
-                            with ThreadPoolExecutor(max_workers=len(self.judge_agents)) as executor:
-                                results = {obj.name: executor.submit(self.interview_agent, obj.name, ques, chat_history) for obj in self.judge_agents}
-                                dim_res.extend([results[obj.name].result() for obj in self.judge_agents])        
+                        if dim == 'judge':
+                            dim_res.extend([results[('goal', agent_name, i, dim, j, k)] for k in range(len(self.judge_agents))])
                         else:
-                            raise NotImplementedError("unsupported eval dimension: {}".format(dim))    
-
+                            dim_res.append(results[('goal', agent_name, i, dim, j)])
                     if goal not in goal_eval_res[agent_name]:
                         goal_eval_res[agent_name][goal] = {}
                     goal_eval_res[agent_name][goal][dim] = dim_res
-        self.goal_eval_res = goal_eval_res
-        
+        return goal_eval_res
+
+    def add_info_requests(self, scheduler, chat_history):
+        """register the interviews for private info reasoning"""
+        for agent_name in self.scene['info_question']:
+            if self.batch_info and len(self.scene['info_question'][agent_name]) > 1:
+                self.add_batch_info_request(scheduler, agent_name, chat_history)
+                continue
+            for i in range(len(self.scene['info_question'][agent_name])):
+                ques = self.scene['info_question'][agent_name][i]['question_with_options']
+                self.add_interview(scheduler, ('info', agent_name, i), agent_name, ques, chat_history, option_marks(ques))
+
+    def add_batch_info_request(self, scheduler, agent_name, chat_history):
+        """register one interview asking an agent all of its info questions, split back into
+        the answers of the single questions, or asked one by one if it cannot be parsed"""
+        questions = [item['question_with_options'] for item in self.scene['info_question'][agent_name]]
+
+        def split(key, answer):
+            choices = parse_json_list(answer, len(questions))
+            for i, ques in enumerate(questions):
+                if choices is not None:
+                    scheduler.set_result(('info', agent_name, i), '({})'.format(str(choices[i]).strip().strip('()')))
+                else:
+                    self.add_interview(scheduler, ('info', agent_name, i), agent_name, ques, chat_history, option_marks(ques))
+
+        # the instruction of question_with_options is given once for all questions
+        ques = batch_question([q[len(INFO_INSTRUCTION):] if q.startswith(INFO_INSTRUCTION) else q for q in questions],
+                              INFO_BATCH_INSTRUCTION, 'strings, each the mark of the chosen option, e.g. "A"')
+        scheduler.add(('info_batch', agent_name), self.endpoint(agent_name),
+                      self.interview_agent, agent_name, ques, chat_history, callback=split, group=agent_name)
+
+    def collect_info_results(self, results):
+        """assemble interview answers into the info reasoning results"""
+        info_eval_res = {}
+        for agent_name in self.scene['info_question']:
+            info_eval_res[agent_name] = [results[('info', agent_name, i)] for i in range(len(self.scene['info_question'][agent_name]))]
+        return info_eval_res
+
+    def evaluate(self):
+        """ evaluate goal completion and private info reasoning with all interviews dispatched together """
+        chat_history = self.chat_history
+        scheduler = EvalScheduler(self.eval_concurrency, self.journal, self.prefix_warmup)
+        self.add_goal_requests(scheduler, chat_history)
+        self.add_info_requests(scheduler, chat_history)
+        results = scheduler.run()
+        self.goal_eval_res = self.collect_goal_results(results)
+        self.info_eval_res = self.collect_info_results(results)
+
+    def eval_goal(self):
+        """ evaluate goal completion """
+        # chat history of social interaction
+        chat_history = self.chat_history
+        scheduler = EvalScheduler(self.eval_concurrency, self.journal, self.prefix_warmup)
+        self.add_goal_requests(scheduler, chat_history)
+        self.goal_eval_res = self.collect_goal_results(scheduler.run())
 
     def eval_info(self):
         """ evaluate private info reasoning """
         # chat history of social interaction
-        chat_history = self.groupchat_result.chat_history
-        info_eval_res = {}
-        for agent_name in self.scene['info_question']:
-            info_eval_res[agent_name] = []
-            for i in range(len(self.scene['info_question'][agent_name])):
-                data = self.scene['info_question'][agent_name][i]
-                ques = data['question_with_options']
-                ans = self.interview_agent(agent_name, ques, chat_history)
-                info_eval_res[agent_name].append(ans)
-        self.info_eval_res = info_eval_res
\ No newline at end of file
+        chat_history = self.chat_history
+        scheduler = EvalScheduler(self.eval_concurrency, self.journal, self.prefix_warmup)
+        self.add_info_requests(scheduler, chat_history)
+        self.info_eval_res = self.collect_info_results(scheduler.run())
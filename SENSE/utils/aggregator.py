@@ -0,0 +1,175 @@
+"""
+Online aggregation of scene results into scene-level and template-level statistics
+"""
+import collections
+import json
+import math
+import os
+import time
+import numpy as np
+
+
+class RunningStat:
+    """Mean and variance updated one value at a time (Welford). With `skipna`, nan values
+    are skipped as by np.nanmean, otherwise they propagate as by np.mean."""
+
+    __slots__ = ('skipna', 'n', 'mean', 'm2')
+
+    def __init__(self, skipna=False):
+        self.skipna = skipna
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        x = float(x)
+        if self.skipna and math.isnan(x):
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def get_mean(self):
+        return self.mean if self.n else math.nan
+
+    def get_std(self, ddof=1):
+        return math.sqrt(self.m2 / (self.n - ddof)) if self.n > ddof else math.nan
+
+
+class GroupStats:
+    """Running statistics of the goal and info scores of a group of scenes."""
+
+    def __init__(self):
+        self.scenes = 0
+        self.goal_self = RunningStat()
+        self.goal_others = RunningStat()
+        # judges skipped by the ensemble have nan scores
+        self.goal_judge = collections.defaultdict(lambda: RunningStat(skipna=True))
+        # scenes without info questions have no info score
+        self.info = RunningStat()
+
+    def add(self, res, judges):
+        self.scenes += 1
+        self.goal_self.add(res['goal_metrics']['self'])
+        self.goal_others.add(res['goal_metrics']['others'])
+        for judge in judges:
+            self.goal_judge[judge].add(res['goal_metrics'][judge])
+        if res['info_metrics']:
+            self.info.add(res['info_metrics']['avg'])
+
+    def summary(self, judges):
+        return {
+            'scenes': self.scenes,
+            'goal_self_score': self.goal_self.get_mean(),
+            'goal_self_std': self.goal_self.get_std(),
+            'goal_others_score': self.goal_others.get_mean(),
+            'goal_others_std': self.goal_others.get_std(),
+            'goal_judge_score': {judge: self.goal_judge[judge].get_mean() for judge in judges},
+            'goal_judge_std': {judge: self.goal_judge[judge].get_std() for judge in judges},
+            'info_score': self.info.get_mean() if self.info.n else 'NONE',
+            'info_score_std': self.info.get_std() if self.info.n > 1 else 'NONE',
+        }
+
+
+def json_safe(value):
+    """nan as null, which json.dump would otherwise write as an invalid NaN literal"""
+    if isinstance(value, dict):
+        return {str(k): json_safe(v) for k, v in value.items()}
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class MetricAggregator:
+    """Aggregate scene results as the scenes finish, with the same numbers as a batch
+    computation over all of them, and write them periodically to a summary file so that
+    partial results survive an interrupted run. The template averages of `tmpl_res` are
+    the reference that the leaderboard and bootstrap scores match.
+
+    `templates` maps scene ids to their template index."""
+
+    def __init__(self, templates, path=None, interval=60):
+        self.templates = templates
+        self.path = path
+        self.interval = interval
+        self.judges = []
+        self.scenes = GroupStats()
+        self.template_stats = collections.OrderedDict()
+        # role -> num of interviews scored over their choices, and of free-text fallbacks
+        self.choice_fallbacks = collections.defaultdict(collections.Counter)
+        self.last_write = time.monotonic()
+
+    def add(self, scene_id, res):
+        for name in res['goal_metrics']:
+            if name.startswith('judge') and name not in self.judges:
+                self.judges.append(name)
+        self.scenes.add(res, self.judges)
+        template_idx = self.templates[scene_id]
+        if template_idx not in self.template_stats:
+            self.template_stats[template_idx] = GroupStats()
+        self.template_stats[template_idx].add(res, self.judges)
+        for role, counts in res.get('choice_fallbacks', {}).items():
+            self.choice_fallbacks[role].update(counts)
+
+    def __len__(self):
+        return self.scenes.scenes
+
+    def scene_res(self):
+        """averages over scenes, as logged under Results of Scenarios"""
+        res = self.scenes.summary(self.judges)
+        return {
+            'goal_self_score': round(res['goal_self_score'], 4),
+            'goal_others_score': round(res['goal_others_score'], 4),
+            'goal_judge_score': {judge: round(score, 4) for judge, score in res['goal_judge_score'].items()},
+            'info_score': round(res['info_score'], 4) if res['info_score'] != 'NONE' else math.nan,
+        }
+
+    def template_res(self):
+        """statistics of each template"""
+        return {template_idx: stats.summary(self.judges) for template_idx, stats in self.template_stats.items()}
+
+    def tmpl_res(self):
+        """averages of the template statistics over templates"""
+        template_res = list(self.template_res().values())
+        res = {
+            'goal_self_score': round(np.mean([r['goal_self_score'] for r in template_res]), 4),
+            'goal_self_std': round(np.mean([r['goal_self_std'] for r in template_res]), 4),
+            'goal_others_score': round(np.mean([r['goal_others_score'] for r in template_res]), 4),
+            'goal_others_std': round(np.mean([r['goal_others_std'] for r in template_res]), 4),
+            'goal_judge_score': {judge: round(np.nanmean([r['goal_judge_score'][judge] for r in template_res]), 4) for judge in self.judges},
+            'goal_judge_std': {judge: round(np.nanmean([r['goal_judge_std'][judge] for r in template_res]), 4) for judge in self.judges},
+        }
+        info_score = [r['info_score'] for r in template_res if r['info_score'] != 'NONE']
+        info_score_std = [r['info_score_std'] for r in template_res if r['info_score_std'] != 'NONE']
+        res['info_score'] = round(np.mean(info_score), 4) if info_score else math.nan
+        res['info_score_std'] = round(np.mean(info_score_std), 4) if info_score_std else math.nan
+        return res
+
+    def summary(self, final=False):
+        summary = {
+            'final': final,
+            'scenes': len(self),
+            'templates': len(self.template_stats),
+            'scenarios': self.scene_res(),
+            'template_avg': self.tmpl_res(),
+            'by_template': self.template_res(),
+        }
+        if self.choice_fallbacks:
+            summary['choice_fallbacks'] = {role: dict(counts) for role, counts in self.choice_fallbacks.items()}
+        return json_safe(summary)
+
+    def maybe_write(self):
+        """write the summary if `interval` seconds passed since the last write"""
+        if self.path is not None and self.interval > 0 and time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self, final=False):
+        if self.path is None or not len(self):
+            return
+        # written to a temporary file first, so that a crash never leaves a truncated summary
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.summary(final), f, indent=2)
+        os.replace(tmp_path, self.path)
+        self.last_write = time.monotonic()
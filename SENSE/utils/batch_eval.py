@@ -0,0 +1,36 @@
+"""
+Batched interview questions answered as a JSON list
+"""
+import json
+import re
+
+
+def batch_question(questions, instruction, answer_format):
+    """one message enumerating the questions, asking for a JSON array of `answer_format`"""
+    lines = [instruction]
+    lines += ['{}. {}'.format(n + 1, question) for n, question in enumerate(questions)]
+    lines.append('Output only a JSON array of {} {}, in the order of the questions.'.format(len(questions), answer_format))
+    return '\n'.join(lines)
+
+
+def parse_json_list(text, length):
+    """the JSON array of `length` items in an answer, or None if it cannot be parsed"""
+    if not isinstance(text, str):
+        return None
+    match = re.search(r'\[.*\]', text, re.DOTALL)
+    if match is None:
+        return None
+    try:
+        items = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(items, list) or len(items) != length:
+        return None
+    return items
+
+
+def verdict_text(item):
+    """a verdict of a JSON array as the Yes/No answer matched by GoalMetric"""
+    if isinstance(item, bool):
+        return 'Yes' if item else 'No'
+    return str(item)
@@ -0,0 +1,117 @@
+"""
+Persistent content-addressed cache of LLM responses
+"""
+import collections
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """SQLite store of LLM responses shared by all agents of a run.
+
+    Entries are keyed on the hash of the endpoint and the request (model,
+    messages, temperature, max_tokens, seed, ...). Once the stored size exceeds
+    `max_size_mb`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_size_mb=1024):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        # role -> counter of hits/misses/sets
+        self.stats = collections.defaultdict(collections.Counter)
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(endpoint, key):
+        return hashlib.sha256('{}\n{}'.format(endpoint, key).encode('utf-8')).hexdigest()
+
+    def get(self, key, default=None, role=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats[role]['misses'] += 1
+                return default
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.stats[role]['hits'] += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, value, role=None):
+        value = pickle.dumps(value)
+        with self.lock:
+            row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+            self.size += len(value)
+            self.stats[role]['sets'] += 1
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # drop the least recently used entries down to 90% of the size limit
+        target = self.max_size * 0.9
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            if self.size <= target:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.size -= size
+            self.evictions += 1
+
+    def view(self, role, endpoint):
+        return CacheView(self, role, endpoint)
+
+    def log_stats(self, logger):
+        for role in sorted(self.stats, key=str):
+            hits, misses = self.stats[role]['hits'], self.stats[role]['misses']
+            logger.info('cache [{}] hits: {} misses: {} hit rate: {}'.format(
+                role, hits, misses, round(hits / (hits + misses), 4) if hits + misses else 'NONE'))
+        logger.info('cache size: {:.2f} MB evictions: {}'.format(self.size / 1024 / 1024, self.evictions))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class CacheView:
+    """A view of a ResponseCache for one role and endpoint, following autogen's
+    AbstractCache protocol so it can be used as the cache of an agent."""
+
+    def __init__(self, store, role, endpoint):
+        self.store = store
+        self.role = role
+        self.endpoint = endpoint
+
+    def get(self, key, default=None):
+        value = self.store.get(self.store.make_key(self.endpoint, key), default, self.role)
+        if value is not default:
+            # mark the response for the instrumentation of llm calls
+            try:
+                value.cache_hit = True
+            except (AttributeError, TypeError, ValueError):
+                pass
+        return value
+
+    def set(self, key, value):
+        self.store.set(self.store.make_key(self.endpoint, key), value, self.role)
+
+    def close(self):
+        # autogen closes the cache after each request, while the store lives for the whole run
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
@@ -0,0 +1,75 @@
+"""
+Single-token scoring of Yes/No and multiple-choice interview questions
+"""
+import math
+import re
+
+SCORING_MODES = ('none', 'logprobs', 'guided')
+
+YES_NO = ['Yes', 'No']
+
+# appended to the questions scored over their choices
+CHOICE_INSTRUCTION = {
+    'goal': "\nAnswer with Yes or No only.",
+    'info': "\nAnswer with the mark of your choice only, without parentheses.",
+}
+
+
+def option_marks(question):
+    """the option marks of a question formatted by question_with_options"""
+    if 'Options: ' not in question:
+        return []
+    return re.findall(r'\(([1-9A-Za-z])\) ', question.split('Options: ')[-1])
+
+
+def scoring_config(mode):
+    """entries of the llm config of the scoring requests"""
+    if mode == 'logprobs':
+        return {"max_tokens": 1, "logprobs": True, "top_logprobs": 20}
+    if mode == 'guided':
+        # the choices of vLLM guided decoding are at most a few tokens long
+        return {"max_tokens": 4, "logprobs": True, "top_logprobs": 20}
+    raise NotImplementedError("unsupported choice scoring: {}".format(mode))
+
+
+def choice_request(mode, choices):
+    """per-request parameters of the scoring requests"""
+    if mode == 'guided':
+        return {"extra_body": {"guided_choice": list(choices)}}
+    return {}
+
+
+def match_choice(text, choices):
+    text = text.strip().strip('().:,;!?"\'').strip().lower()
+    for choice in choices:
+        if text == choice.lower():
+            return choice
+    return None
+
+
+def choice_distribution(response, choices):
+    """probabilities of the choices, normalized over the top logprobs of the first
+    generated token, or one-hot on the generated choice if there are no logprobs.
+    None if no choice was matched"""
+    choice = response.choices[0]
+    logprobs = getattr(choice, 'logprobs', None)
+    content = getattr(logprobs, 'content', None) if logprobs is not None else None
+    if content:
+        first = content[0]
+        mass = {}
+        for item in (first.top_logprobs or [first]):
+            matched = match_choice(item.token, choices)
+            if matched is not None:
+                mass[matched] = mass.get(matched, 0.0) + math.exp(item.logprob)
+        total = sum(mass.values())
+        if total > 0:
+            return {c: mass.get(c, 0.0) / total for c in choices}
+    matched = match_choice(choice.message.content or "", choices)
+    if matched is not None:
+        return {c: float(c == matched) for c in choices}
+    return None
+
+
+def format_choice(choice, choices):
+    """the answer text of the most likely choice, as parsed by GoalMetric and SingleChoiceMetric"""
+    return choice if choices == YES_NO else '({})'.format(choice)
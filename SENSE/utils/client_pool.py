@@ -0,0 +1,240 @@
+"""
+Process-wide pool of HTTP clients shared by all agents and judges
+"""
+import collections
+import threading
+import time
+import weakref
+import httpx
+from .rate_limit import LIMITS
+from .routing import ROUTE_HEADER, ReplicaSet, replicas
+
+
+class SharedClient(httpx.Client):
+    """An httpx client kept as is when autogen deep-copies the llm config holding it."""
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class SharedAsyncClient(httpx.AsyncClient):
+    """The asyncio counterpart of SharedClient."""
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class TrackedStream(httpx.SyncByteStream):
+    """A response body calling `on_close` once it is closed, i.e. when the request is really done."""
+
+    def __init__(self, stream, on_close):
+        self.stream = stream
+        self.on_close = on_close
+
+    def __iter__(self):
+        yield from self.stream
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+                self.on_close = None
+
+
+class AsyncTrackedStream(httpx.AsyncByteStream):
+    """The asyncio counterpart of TrackedStream."""
+
+    def __init__(self, stream, on_close):
+        self.stream = stream
+        self.on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+                self.on_close = None
+
+
+def rewrite_url(url, prefix, replica):
+    """the url of a request to the first replica, sent to `replica` instead"""
+    url = str(url)
+    return httpx.URL(replica.url.rstrip('/') + url[len(prefix):]) if url.startswith(prefix) else httpx.URL(url)
+
+
+class RoutingTransport(httpx.BaseTransport):
+    """Send the requests of a client built for the first replica of a model to the
+    replica chosen by its ReplicaSet."""
+
+    def __init__(self, replica_set, **kwargs):
+        self.replica_set = replica_set
+        self.prefix = str(httpx.URL(replica_set.replicas[0].url)).rstrip('/')
+        self.transport = httpx.HTTPTransport(**kwargs)
+
+    def handle_request(self, request):
+        replica = self.replica_set.pick(request.headers.get(ROUTE_HEADER))
+        request.url = rewrite_url(request.url, self.prefix, replica)
+        request.headers['Host'] = request.url.netloc.decode('ascii')
+        start = time.perf_counter()
+        try:
+            response = self.transport.handle_request(request)
+        except Exception as e:
+            self.replica_set.release(replica, time.perf_counter() - start, error=e)
+            raise
+        response.stream = TrackedStream(response.stream, lambda: self.replica_set.release(
+            replica, time.perf_counter() - start, status=response.status_code))
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRoutingTransport(httpx.AsyncBaseTransport):
+    """The asyncio counterpart of RoutingTransport."""
+
+    def __init__(self, replica_set, **kwargs):
+        self.replica_set = replica_set
+        self.prefix = str(httpx.URL(replica_set.replicas[0].url)).rstrip('/')
+        self.transport = httpx.AsyncHTTPTransport(**kwargs)
+
+    async def handle_async_request(self, request):
+        replica = self.replica_set.pick(request.headers.get(ROUTE_HEADER))
+        request.url = rewrite_url(request.url, self.prefix, replica)
+        request.headers['Host'] = request.url.netloc.decode('ascii')
+        start = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception as e:
+            self.replica_set.release(replica, time.perf_counter() - start, error=e)
+            raise
+        response.stream = AsyncTrackedStream(response.stream, lambda: self.replica_set.release(
+            replica, time.perf_counter() - start, status=response.status_code))
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ConnectionTracker:
+    """Count requests and the connections they were sent on, from the network
+    stream httpx attaches to each response."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.streams = weakref.WeakSet()
+
+    def on_response(self, response):
+        stream = response.extensions.get("network_stream")
+        with self.lock:
+            self.requests += 1
+            if stream is None:
+                return
+            try:
+                if stream not in self.streams:
+                    self.streams.add(stream)
+                    self.new_connections += 1
+            except TypeError:
+                # streams without weak references are counted as new connections
+                self.new_connections += 1
+
+    async def a_on_response(self, response):
+        self.on_response(response)
+
+
+class ClientRegistry:
+    """HTTP clients keyed by (base_url, api_key, api_type), so that the OpenAI
+    clients of all agents, judges and scenes share their connection pools.
+
+    A model served by several replicas is given as a list or comma-separated base_url.
+    Its clients are built for the first replica, which identifies the model in rate
+    limits and metrics, and route each request to a replica of its ReplicaSet."""
+
+    def __init__(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.async_clients = {}
+        self.replica_sets = {}
+        self.replica_kwargs = {}
+        self.trackers = collections.defaultdict(ConnectionTracker)
+        self.configure(max_connections, max_keepalive_connections, keepalive_expiry)
+
+    def configure(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0, logger=None, **replica_kwargs):
+        """set the pool size and keep-alive of the clients created afterwards, and the
+        routing and eviction of the replica sets, see ReplicaSet"""
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.replica_kwargs = dict(replica_kwargs, logger=logger)
+
+    def _replica_set(self, urls):
+        # called with the lock held
+        if len(urls) > 1 and urls[0] not in self.replica_sets:
+            self.replica_sets[urls[0]] = ReplicaSet(urls, **self.replica_kwargs)
+        return self.replica_sets.get(urls[0])
+
+    def replica_set(self, base_url):
+        """the ReplicaSet of a base_url, None if served by a single replica"""
+        with self.lock:
+            return self._replica_set(replicas(base_url))
+
+    def get(self, base_url, api_key, api_type=None):
+        urls = replicas(base_url)
+        key = (urls[0], api_key, api_type)
+        with self.lock:
+            if key not in self.clients:
+                replica_set = self._replica_set(urls)
+                self.clients[key] = SharedClient(
+                    limits=self.limits, follow_redirects=True,
+                    transport=RoutingTransport(replica_set, limits=self.limits) if replica_set is not None else None,
+                    event_hooks={"response": [self.trackers[key].on_response,
+                                              lambda response: LIMITS.on_response(urls[0], response)]},
+                )
+            return self.clients[key]
+
+    def get_async(self, base_url, api_key, api_type=None):
+        urls = replicas(base_url)
+        key = (urls[0], api_key, api_type)
+        with self.lock:
+            if key not in self.async_clients:
+                replica_set = self._replica_set(urls)
+                self.async_clients[key] = SharedAsyncClient(
+                    limits=self.limits, follow_redirects=True,
+                    transport=AsyncRoutingTransport(replica_set, limits=self.limits) if replica_set is not None else None,
+                    event_hooks={"response": [self.trackers[key].a_on_response,
+                                              lambda response: LIMITS.a_on_response(urls[0], response)]},
+                )
+            return self.async_clients[key]
+
+    def log_stats(self, logger):
+        for (base_url, _, api_type), tracker in self.trackers.items():
+            if tracker.requests:
+                logger.info('http clients [{} {}] requests: {} new connections: {} reuse rate: {}'.format(
+                    base_url, api_type, tracker.requests, tracker.new_connections,
+                    round(1 - tracker.new_connections / tracker.requests, 4)))
+        for replica_set in self.replica_sets.values():
+            replica_set.log_stats(logger)
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+    async def a_close(self):
+        for client in list(self.async_clients.values()):
+            await client.aclose()
+        self.async_clients.clear()
+
+
+CLIENTS = ClientRegistry()
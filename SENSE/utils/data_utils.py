@@ -3,7 +3,7 @@ import yaml
 import json
 import os
 import collections
-import numpy as np
+import hashlib
 
 def question_with_options(item, option_mark='random'):
     alphabet = ['abcdefghijklmnopqrstuvwxyz',
@@ -34,27 +34,58 @@ def question_with_options(item, option_mark='random'):
     return instruct+ret
 
 
-def generate_batch_config(
+def stop_sequence_config(trunc_mode, trunc_symbol='\n'):
+    """entries of the agent llm config for truncating dialog turns"""
+    if trunc_mode == 'client':
+        # truncated by TextMessageTruncate after generation
+        return {}
+    elif trunc_mode == 'stop':
+        # truncated by the server, see StopSequenceClient
+        return {"stop": [trunc_symbol], "model_client_cls": "StopSequenceClient"}
+    raise NotImplementedError("unsupported truncation mode: {}".format(trunc_mode))
+
+
+def shard_templates(data, num_shards):
+    """assign whole templates to shards, greedily from the largest template to the
+    least loaded shard, so that each shard holds complete templates and about the same
+    number of scenes"""
+    sizes = collections.Counter(d['template_idx'] for d in data)
+    loads = [0] * num_shards
+    assignment = {}
+    for template_idx, size in sorted(sizes.items(), key=lambda item: (-item[1], str(item[0]))):
+        shard = loads.index(min(loads))
+        assignment[template_idx] = shard
+        loads[shard] += size
+    return assignment
+
+
+def build_batch_config(
     input_path,
-    output_dir,
     prompt_template,
     judge_prompt_template,
     max_round,
     speaker_selection_method,
     allow_repeat_speaker,
-    model,
-    base_url,
-    api_key,
-    api_type,
     temperature,
     max_tokens,
     judge_config,
-    option_mark
+    option_mark,
+    trunc_mode='client',
+    agent_llm=None,
+    num_shards=1,
+    shard_id=0
     ):
-    lines = open(input_path,'r').readlines()
+    """build the task configs of all scenes in memory. `agent_llm` gives the model,
+    base_url, api_key and api_type of homogeneous agents, otherwise they are read from
+    each character. A base_url may list the urls of several replicas of the model. With
+    `num_shards` > 1, only the scenes of the templates assigned to `shard_id` are built"""
+    lines = [json.loads(line) for line in open(input_path,'r').readlines()]
+    if num_shards > 1:
+        assignment = shard_templates(lines, num_shards)
+        lines = [line for line in lines if assignment[line['template_idx']] == shard_id]
     judge_config = json.load(open(judge_config,'r'))
+    configs = []
     for line in lines:
-        line = json.loads(line)
 
         if max_round<1:
             # using automatic round settings
@@ -62,6 +93,7 @@ def generate_batch_config(
 
         scene={
             "scene_id":line["sample_idx"],
+            "template_idx":line["template_idx"],
             "background":line["background"],
             "desc":line["description"],
             "goal_question":{char["name"]:char["goals"] for char in line["characters"]},
@@ -84,12 +116,10 @@ def generate_batch_config(
                 "private_info":agent["private_info"] if agent["private_info"] else "",
                 "prompt_template": prompt_template,
                 "llm":{
-                    "model":model,
-                    "base_url":base_url,
-                    "api_key":api_key,
-                    "api_type":api_type,
+                    **(agent_llm if agent_llm is not None else {key: agent[key] for key in ("model", "base_url", "api_key", "api_type")}),
                     "temperature":temperature,
-                    "max_tokens":max_tokens
+                    "max_tokens":max_tokens,
+                    **stop_sequence_config(trunc_mode)
                 }
 
             }
@@ -100,6 +130,8 @@ def generate_batch_config(
             {
             "name":"judge_"+config['judge_model'],
             "prompt_template":judge_prompt_template,
+            # relative cost of the judge, the cheapest being queried first by judge ensembles
+            "cost":config.get('judge_cost', 0),
             "llm":{
                 "model":config['judge_model'],
                 "base_url":config['judge_base_url'],
@@ -112,163 +144,57 @@ def generate_batch_config(
             for config in judge_config
         ]
         
-        data={
+        configs.append({
             "scene":scene,
             "groupchat":groupchat,
             "agents":agents,
             "judge_agents":judge_agents
-        }
+        })
+    return configs
+
 
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        with open(output_dir+f'/{line["sample_idx"]}.yaml', 'w') as f:
+def write_batch_config(configs, output_dir):
+    """write one yaml config per scene"""
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for data in configs:
+        with open(output_dir+f'/{data["scene"]["scene_id"]}.yaml', 'w') as f:
             yaml.dump(data, f, default_flow_style=False, sort_keys=False)
 
 
-def generate_heter_batch_config(
-    input_path,
-    output_dir,
-    prompt_template,
-    judge_prompt_template,
-    max_round,
-    speaker_selection_method,
-    allow_repeat_speaker,
-    temperature,
-    max_tokens,
-    judge_config,
-    option_mark
-    ):
-    """using different llms for agents"""
-    lines = open(input_path,'r').readlines()
-    judge_config = json.load(open(judge_config,'r'))
-    for line in lines:
-        line = json.loads(line)
+# bumped when the format of task configs changes, so that older bundles are rebuilt
+BUNDLE_VERSION = 2
 
-        if max_round<1:
-            # using automatic round settings
-            max_round = len(line["characters"])*10
 
-        scene={
-            "scene_id":line["sample_idx"],
-            "background":line["background"],
-            "desc":line["description"],
-            "goal_question":{char["name"]:char["goals"] for char in line["characters"]},
-            "info_question":{char["name"]:char["info_reason_questions"] for char in line["characters"]},
-            "option_mark":option_mark,
-        }
+def bundle_key(input_path, judge_config, **kwargs):
+    """hash of the files and arguments that task configs are built from"""
+    h = hashlib.sha256()
+    h.update(str(BUNDLE_VERSION).encode('utf-8'))
+    for path in (input_path, judge_config):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    h.update(json.dumps(kwargs, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
 
-        groupchat={
-            "messages":[],
-            "max_round":max_round,
-            "speaker_selection_method":speaker_selection_method,
-            "allow_repeat_speaker":allow_repeat_speaker,
-        }
-        agents=[
-            {
-                "name":agent["name"],
-                "profile":agent["profile"],
-                "social_goal":[d["goal"] for d in agent["goals"]],
-                "private_info":agent["private_info"] if agent["private_info"] else "",
-                "prompt_template": prompt_template,
-                "llm":{
-                    "model":agent["model"],
-                    "base_url":agent["base_url"],
-                    "api_key":agent["api_key"],
-                    "api_type":agent["api_type"],
-                    "temperature":temperature,
-                    "max_tokens":max_tokens
-                }
 
-            }
-            for agent in line["characters"]
-        ]
-
-        judge_agents=[
-            {
-            "name":"judge_"+config['judge_model'],
-            "prompt_template":judge_prompt_template,
-            "llm":{
-                "model":config['judge_model'],
-                "base_url":config['judge_base_url'],
-                "api_key":config['judge_api_key'],
-                "api_type":config['judge_api_type'],
-                "temperature":config['judge_temperature'],
-                "max_tokens":config['judge_max_tokens']
-                }              
-            }
-            for config in judge_config
-        ]
-        
-        data={
-            "scene":scene,
-            "groupchat":groupchat,
-            "agents":agents,
-            "judge_agents":judge_agents
-        }
+def load_task_bundle(bundle_path, key):
+    """task configs saved in a bundle, or None if the bundle was built from other inputs"""
+    if not os.path.exists(bundle_path):
+        return None
+    with open(bundle_path, 'r') as f:
+        if json.loads(f.readline()).get('key') != key:
+            return None
+        return [json.loads(line) for line in f]
 
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        with open(output_dir+f'/{line["sample_idx"]}.yaml', 'w') as f:
-            yaml.dump(data, f, default_flow_style=False, sort_keys=False)
 
-def calculate_tmpl_res(all_res, input_path):
-    data = open(input_path, 'r').readlines()
-    data = [json.loads(s) for s in data]
-    template_dict = collections.defaultdict(list)
-    for d in data:
-        template_dict[d['template_idx']].append(d['sample_idx'])
-    template_res = {}
-    judges = [name for name in all_res[list(all_res.keys())[0]]['goal_metrics'] if name.startswith('judge')]
-    for template_idx in template_dict:
-        goal_self_score = [all_res[key]['goal_metrics']['self'] for key in template_dict[template_idx]]
-        goal_others_score = [all_res[key]['goal_metrics']['others'] for key in template_dict[template_idx]]
-        judge_score_dict = {}
-        judge_std_dict = {}
-        for judge in judges:
-            goal_judge_score = [all_res[key]['goal_metrics'][judge] for key in template_dict[template_idx]]
-            goal_judge_std = np.std(goal_judge_score,ddof=1)
-            goal_judge_score = np.mean(goal_judge_score)
-            judge_score_dict[judge] = goal_judge_score
-            judge_std_dict[judge] = goal_judge_std
-        info_score = [all_res[key]['info_metrics']['avg'] for key in template_dict[template_idx] if all_res[key]['info_metrics']]
-        goal_self_std = np.std(goal_self_score,ddof=1)
-        goal_self_score = np.mean(goal_self_score)
-        goal_others_std = np.std(goal_others_score,ddof=1)
-        goal_others_score = np.mean(goal_others_score)
-        info_score_std = np.std(info_score,ddof=1) if len(info_score)>1 else 'NONE'    
-        info_score = np.mean(info_score) if len(info_score) else 'NONE'     
-        template_res[template_idx] = {
-            'goal_self_score':goal_self_score,
-            'goal_self_std':goal_self_std,
-            'goal_others_score':goal_others_score,
-            'goal_others_std':goal_others_std,
-            'goal_judge_score':judge_score_dict,
-            'goal_judge_std':judge_std_dict,            
-            'info_score':info_score,
-            'info_score_std':info_score_std
-            }
-    print('# of templates:', len(template_res))
-    goal_self_score = np.mean([template_res[key]['goal_self_score'] for key in template_res])
-    goal_self_std = np.mean([template_res[key]['goal_self_std'] for key in template_res])
-    goal_others_score = np.mean([template_res[key]['goal_others_score'] for key in template_res])
-    goal_others_std = np.mean([template_res[key]['goal_others_std'] for key in template_res])  
-    goal_judge_score, goal_judge_std = {},{}
-    for judge in judges:
-        goal_judge_score[judge] = round(np.mean([template_res[key]['goal_judge_score'][judge] for key in template_res]), 4) 
-        goal_judge_std[judge] = round(np.mean([template_res[key]['goal_judge_std'][judge] for key in template_res]), 4)
-    info_score = np.mean([template_res[key]['info_score'] for key in template_res if type(template_res[key]['info_score'])!=str])
-    info_score_std = np.mean([template_res[key]['info_score_std'] for key in template_res if type(template_res[key]['info_score_std'])!=str])        
-    res = {
-            'goal_self_score':round(goal_self_score,4),
-            'goal_self_std':round(goal_self_std,4),
-            'goal_others_score':round(goal_others_score,4),
-            'goal_others_std':round(goal_others_std,4),
-            'goal_judge_score':goal_judge_score,
-            'goal_judge_std':goal_judge_std,          
-            'info_score':round(info_score,4),
-            'info_score_std':round(info_score_std, 4)
-            }
-    return res
+def save_task_bundle(configs, bundle_path, key):
+    """save task configs as a single jsonl file headed by the hash of their inputs"""
+    if os.path.dirname(bundle_path) and not os.path.exists(os.path.dirname(bundle_path)):
+        os.makedirs(os.path.dirname(bundle_path))
+    with open(bundle_path, 'w') as f:
+        f.write(json.dumps({'key': key}) + '\n')
+        for data in configs:
+            f.write(json.dumps(data) + '\n')
 
 
 if __name__ == "__main__":
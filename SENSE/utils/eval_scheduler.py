@@ -0,0 +1,130 @@
+"""
+Concurrent scheduler for the interviews of a single scene
+"""
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class EvalScheduler:
+    """Collect all interview requests of a scene into one work graph and
+    dispatch them concurrently, with at most `endpoint_concurrency` requests
+    in flight per endpoint. Answers found in the journal are reused, and new
+    ones are recorded to it as they complete."""
+
+    def __init__(self, endpoint_concurrency=4, journal=None, prefix_warmup=False):
+        if endpoint_concurrency < 1:
+            raise ValueError("endpoint_concurrency must be a positive integer.")
+        self.endpoint_concurrency = endpoint_concurrency
+        self.journal = journal
+        # endpoint -> queue of pending requests
+        self.queues = collections.OrderedDict()
+        self.results = {}
+        # requests of a group share a prompt prefix: with prefix_warmup, they are sent back
+        # to back, and only once the first one is done so that its prefix is cached
+        self.prefix_warmup = prefix_warmup
+        self.group_order = {}
+        self.warming = set()
+        self.warm = set()
+
+    def add(self, key, endpoint, fn, *args, callback=None, group=None):
+        """Register a request. `callback(key, result)` is called in the dispatching
+        thread once the request is done, and may register follow-up requests."""
+        if self.journal is not None and key in self.journal.answers:
+            self._complete(key, self.journal.answers[key], callback)
+            return
+        if endpoint not in self.queues:
+            self.queues[endpoint] = collections.deque()
+        if group is not None:
+            self.group_order.setdefault(group, len(self.group_order))
+        self.queues[endpoint].append((key, fn, args, callback, group))
+
+    def set_result(self, key, result):
+        """Set the result of a key derived from another request, e.g. split from a batched answer."""
+        self.results[key] = result
+
+    def _complete(self, key, result, callback):
+        self.results[key] = result
+        if callback is not None:
+            callback(key, result)
+
+    def _dispatch(self, running):
+        # pop requests of every endpoint until its concurrency limit is reached
+        for endpoint, queue in self.queues.items():
+            if not self.prefix_warmup:
+                while queue and running[endpoint] < self.endpoint_concurrency:
+                    yield endpoint, queue.popleft()
+                continue
+            # hold the requests of groups whose first request is still in flight
+            held = []
+            while queue and running[endpoint] < self.endpoint_concurrency:
+                request = queue.popleft()
+                group = request[4]
+                if group is None or group in self.warm:
+                    yield endpoint, request
+                elif group not in self.warming:
+                    self.warming.add(group)
+                    yield endpoint, request
+                else:
+                    held.append(request)
+            queue.extendleft(reversed(held))
+
+    def _sort_queues(self):
+        # back to back by group, in the order the groups were first added
+        if self.prefix_warmup:
+            for endpoint, queue in self.queues.items():
+                self.queues[endpoint] = collections.deque(sorted(
+                    queue, key=lambda request: self.group_order.get(request[4], -1)))
+
+    def _done(self, group):
+        if group in self.warming:
+            self.warming.discard(group)
+            self.warm.add(group)
+
+    def run(self):
+        """Run all registered requests and return a dict mapping keys to results."""
+        running = collections.Counter()
+        futures = {}
+        max_workers = self.endpoint_concurrency * max(len(self.queues), 1)
+        self._sort_queues()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                for endpoint, (key, fn, args, callback, group) in self._dispatch(running):
+                    futures[executor.submit(fn, *args)] = (key, endpoint, callback, group)
+                    running[endpoint] += 1
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, endpoint, callback, group = futures.pop(future)
+                    running[endpoint] -= 1
+                    self._done(group)
+                    if self.journal is not None:
+                        self.journal.record_answer(key, future.result())
+                    self._complete(key, future.result(), callback)
+        return self.results
+
+    async def a_run(self):
+        """The asyncio counterpart of `run`, where requests are coroutine functions."""
+        running = collections.Counter()
+        tasks = {}
+        self._sort_queues()
+        try:
+            while True:
+                for endpoint, (key, fn, args, callback, group) in self._dispatch(running):
+                    tasks[asyncio.ensure_future(fn(*args))] = (key, endpoint, callback, group)
+                    running[endpoint] += 1
+                if not tasks:
+                    break
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key, endpoint, callback, group = tasks.pop(task)
+                    running[endpoint] -= 1
+                    self._done(group)
+                    if self.journal is not None:
+                        self.journal.record_answer(key, task.result())
+                    self._complete(key, task.result(), callback)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return self.results
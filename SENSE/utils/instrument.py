@@ -0,0 +1,286 @@
+"""
+Token, latency and retry instrumentation of LLM calls
+"""
+import collections
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import numpy as np
+
+# retry counter of the current call, incremented from the log records of the openai client
+RETRIES = contextvars.ContextVar('retries', default=None)
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120]
+
+
+class RetryCounter(logging.Handler):
+    """Count the retries of the openai client, which logs each of them at INFO level."""
+
+    def emit(self, record):
+        counter = RETRIES.get()
+        if counter is not None and record.getMessage().startswith('Retrying request'):
+            counter[0] += 1
+
+
+def summarize(records):
+    """aggregate call records into token, latency and throughput statistics"""
+    summary = {
+        "calls": len(records),
+        "errors": sum(1 for r in records if r["error"] is not None),
+        "retries": sum(r["retries"] for r in records),
+        "cache_hits": sum(1 for r in records if r["cached"]),
+        "prompt_tokens": sum(r["prompt_tokens"] for r in records),
+        "completion_tokens": sum(r["completion_tokens"] for r in records),
+        "cached_prompt_tokens": sum(r["cached_prompt_tokens"] for r in records),
+    }
+    if summary["prompt_tokens"]:
+        summary["prefix_cache_hit_rate"] = summary["cached_prompt_tokens"] / summary["prompt_tokens"]
+    # latency of the requests actually sent to the endpoints
+    latency = np.array([r["latency"] for r in records if not r["cached"]])
+    if len(latency):
+        p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+        summary["latency"] = {"mean": float(latency.mean()), "p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(latency.max())}
+    if records:
+        span = max(r["end"] for r in records) - min(r["end"] - r["latency"] for r in records)
+        if span > 0:
+            summary["throughput"] = {
+                "calls_per_sec": len(records) / span,
+                "completion_tokens_per_sec": summary["completion_tokens"] / span,
+            }
+    return summary
+
+
+def group_summaries(records, field):
+    groups = collections.defaultdict(list)
+    for r in records:
+        groups[r[field]].append(r)
+    return {str(key): summarize(group) for key, group in groups.items()}
+
+
+def parse_prom_metrics(text, names):
+    """sum of the samples of each metric in a prometheus text exposition, over all labels"""
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        name = parts[0].split('{', 1)[0]
+        if name in names:
+            try:
+                values[name] = values.get(name, 0.0) + float(parts[1])
+            except ValueError:
+                continue
+    return values
+
+
+class PrefixCacheProbe:
+    """Scrape the prefix cache counters of vLLM servers at the start and end of a run,
+    so that the hit rate of the run is measured on the server side as well."""
+
+    HITS = 'vllm:prefix_cache_hits_total'
+    QUERIES = 'vllm:prefix_cache_queries_total'
+    # older vLLM versions only expose the hit rate since the server started
+    HIT_RATE = 'vllm:gpu_prefix_cache_hit_rate'
+
+    def __init__(self, endpoints, timeout=5.0):
+        self.endpoints = sorted(set(endpoints))
+        self.timeout = timeout
+        self.start = {}
+
+    def scrape(self, endpoint):
+        """the counters of an endpoint, or None if its metrics cannot be read"""
+        import httpx
+        url = endpoint.rstrip('/')
+        if url.endswith('/v1'):
+            url = url[:-len('/v1')]
+        try:
+            response = httpx.get(url + '/metrics', timeout=self.timeout)
+            response.raise_for_status()
+        except httpx.HTTPError:
+            return None
+        return parse_prom_metrics(response.text, (self.HITS, self.QUERIES, self.HIT_RATE))
+
+    def begin(self):
+        self.start = {endpoint: self.scrape(endpoint) for endpoint in self.endpoints}
+
+    def log_stats(self, logger):
+        for endpoint in self.endpoints:
+            start, end = self.start.get(endpoint), self.scrape(endpoint)
+            if not start or not end:
+                continue
+            if self.QUERIES in end and self.QUERIES in start:
+                queries = end[self.QUERIES] - start[self.QUERIES]
+                if queries > 0:
+                    logger.info('server prefix cache [{}] queries: {} hit rate: {}'.format(
+                        endpoint, int(queries), round((end.get(self.HITS, 0) - start.get(self.HITS, 0)) / queries, 4)))
+            elif self.HIT_RATE in end:
+                logger.info('server prefix cache [{}] hit rate since start: {}'.format(endpoint, round(end[self.HIT_RATE], 4)))
+
+
+def prom_labels(**labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels.items())
+
+
+class LLMCallRecorder:
+    """Record tokens, latency, retries and endpoint of every LLM call made by the
+    agents and judges, and aggregate them per scene and per run.
+
+    Retries are counted from the INFO records of the openai client logger, whose level
+    is lowered to INFO while recording if it is higher, and restored with its handlers
+    by `write`."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.openai_logger = logging.getLogger('openai._base_client')
+        self.openai_level = self.openai_logger.level
+        if self.openai_logger.getEffectiveLevel() > logging.INFO:
+            self.openai_logger.setLevel(logging.INFO)
+        self.retry_counter = None
+        if not any(isinstance(handler, RetryCounter) for handler in self.openai_logger.handlers):
+            self.retry_counter = RetryCounter()
+            self.openai_logger.addHandler(self.retry_counter)
+
+    def detach(self):
+        """stop counting retries, restoring the openai client logger"""
+        self.openai_logger.setLevel(self.openai_level)
+        if self.retry_counter is not None:
+            self.openai_logger.removeHandler(self.retry_counter)
+            self.retry_counter = None
+
+    def wrap_agent(self, agent, labels, role):
+        """Instrument the client of an autogen agent. `labels` is shared by the
+        agents of a scene and holds its scene id and current phase."""
+        self.wrap_client(agent.client, agent.llm_config['config_list'][0], agent.name, labels, role)
+
+    def wrap_client(self, client, config, agent_name, labels, role):
+        """Instrument an autogen OpenAIWrapper used on behalf of an agent."""
+        create = client.create
+
+        def instrumented_create(**kwargs):
+            return self.call(create, labels, agent_name, role, config, **kwargs)
+
+        client.create = instrumented_create
+
+    def call(self, fn, labels, agent_name, role, config, **kwargs):
+        start, counter = time.perf_counter(), [0]
+        token = RETRIES.set(counter)
+        try:
+            response = fn(**kwargs)
+        except Exception as e:
+            self.observe(labels, agent_name, role, config, start, counter, error=e)
+            raise
+        finally:
+            RETRIES.reset(token)
+        self.observe(labels, agent_name, role, config, start, counter, response=response)
+        return response
+
+    async def a_call(self, fn, labels, agent_name, role, config, **kwargs):
+        """the asyncio counterpart of `call`"""
+        start, counter = time.perf_counter(), [0]
+        token = RETRIES.set(counter)
+        try:
+            response = await fn(**kwargs)
+        except Exception as e:
+            self.observe(labels, agent_name, role, config, start, counter, error=e)
+            raise
+        finally:
+            RETRIES.reset(token)
+        self.observe(labels, agent_name, role, config, start, counter, response=response)
+        return response
+
+    def observe(self, labels, agent_name, role, config, start, counter, response=None, error=None):
+        usage = getattr(response, 'usage', None)
+        details = getattr(usage, 'prompt_tokens_details', None)
+        record = {
+            "scene_id": labels.get("scene_id"),
+            "agent": agent_name,
+            "role": role,
+            "phase": 'judge' if role == 'judge' else labels.get("phase"),
+            "endpoint": config.get("base_url"),
+            "model": config.get("model"),
+            "prompt_tokens": getattr(usage, 'prompt_tokens', 0) or 0,
+            "completion_tokens": getattr(usage, 'completion_tokens', 0) or 0,
+            "cached_prompt_tokens": getattr(details, 'cached_tokens', 0) or 0,
+            "latency": time.perf_counter() - start,
+            "end": time.time(),
+            "retries": counter[0],
+            "cached": bool(getattr(response, 'cache_hit', False)),
+            "error": type(error).__name__ if error is not None else None,
+        }
+        with self.lock:
+            self.records.append(record)
+
+    def summary(self):
+        with self.lock:
+            records = list(self.records)
+        scenes = collections.defaultdict(list)
+        for r in records:
+            scenes[r["scene_id"]].append(r)
+        return {
+            "run": summarize(records),
+            "by_phase": group_summaries(records, "phase"),
+            "by_endpoint": group_summaries(records, "endpoint"),
+            "by_model": group_summaries(records, "model"),
+            "by_judge": group_summaries([r for r in records if r["role"] == 'judge'], "agent"),
+            "scenes": {str(scene_id): {
+                "total": summarize(scene_records),
+                "by_phase": group_summaries(scene_records, "phase"),
+                "by_agent": group_summaries(scene_records, "agent"),
+            } for scene_id, scene_records in scenes.items()},
+        }
+
+    def prometheus(self):
+        """run-level metrics in the Prometheus text format"""
+        with self.lock:
+            records = list(self.records)
+        groups = collections.defaultdict(list)
+        for r in records:
+            groups[(r["phase"], r["endpoint"], r["model"])].append(r)
+        counters = [
+            ("sense_llm_calls_total", "Number of LLM calls.", lambda rs: len(rs)),
+            ("sense_llm_errors_total", "Number of failed LLM calls.", lambda rs: sum(1 for r in rs if r["error"] is not None)),
+            ("sense_llm_retries_total", "Number of retried LLM requests.", lambda rs: sum(r["retries"] for r in rs)),
+            ("sense_llm_cache_hits_total", "Number of LLM calls served by the response cache.", lambda rs: sum(1 for r in rs if r["cached"])),
+            ("sense_llm_prompt_tokens_total", "Number of prompt tokens.", lambda rs: sum(r["prompt_tokens"] for r in rs)),
+            ("sense_llm_completion_tokens_total", "Number of completion tokens.", lambda rs: sum(r["completion_tokens"] for r in rs)),
+        ]
+        lines = []
+        for name, help_text, fn in counters:
+            lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} counter'.format(name)]
+            for (phase, endpoint, model), rs in groups.items():
+                lines.append('{}{{{}}} {}'.format(name, prom_labels(phase=phase, endpoint=endpoint, model=model), fn(rs)))
+        name = "sense_llm_latency_seconds"
+        lines += ['# HELP {} Latency of LLM requests.'.format(name), '# TYPE {} histogram'.format(name)]
+        for (phase, endpoint, model), rs in groups.items():
+            latency = np.array([r["latency"] for r in rs if not r["cached"]])
+            for le in LATENCY_BUCKETS:
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, prom_labels(phase=phase, endpoint=endpoint, model=model), le, int((latency <= le).sum())))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, prom_labels(phase=phase, endpoint=endpoint, model=model), len(latency)))
+            lines.append('{}_sum{{{}}} {}'.format(name, prom_labels(phase=phase, endpoint=endpoint, model=model), float(latency.sum())))
+            lines.append('{}_count{{{}}} {}'.format(name, prom_labels(phase=phase, endpoint=endpoint, model=model), len(latency)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, output_dir, logger=None, name='llm_metrics'):
+        """write the summaries next to the run log, once the calls are done"""
+        self.detach()
+        summary = self.summary()
+        with open(os.path.join(output_dir, name + '.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        with open(os.path.join(output_dir, name + '.prom'), 'w') as f:
+            f.write(self.prometheus())
+        if logger is not None:
+            for phase, stats in summary["by_phase"].items():
+                logger.info('llm calls [{}] calls: {} prompt tokens: {} completion tokens: {} latency: {}'.format(
+                    phase, stats["calls"], stats["prompt_tokens"], stats["completion_tokens"],
+                    {k: round(v, 3) for k, v in stats.get("latency", {}).items()}))
+            for endpoint, stats in summary["by_endpoint"].items():
+                if "prefix_cache_hit_rate" in stats:
+                    logger.info('prefix cache [{}] cached prompt tokens: {} hit rate: {}'.format(
+                        endpoint, stats["cached_prompt_tokens"], round(stats["prefix_cache_hit_rate"], 4)))
+        return summary
@@ -0,0 +1,77 @@
+"""
+Append-only journal of a scene for resuming interrupted runs
+"""
+import json
+import os
+import threading
+
+
+class SceneJournal:
+    """Record each dialog turn and interview answer of a scene as soon as it
+    completes, one JSON object per line, and replay them when reopened."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # (name, content) of the dialog turns in order
+        self.turns = []
+        # interview key -> answer
+        self.answers = {}
+        # reason of the early termination of the dialog, if any
+        self.stop = None
+        if os.path.exists(path):
+            self._load()
+        elif os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = None
+
+    def _load(self):
+        # offset after the last complete record
+        end = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                # the last line may be partially written when the run was killed
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                end += len(line)
+                if record['type'] == 'turn':
+                    self.turns.append((record['name'], record['content']))
+                elif record['type'] == 'answer':
+                    self.answers[tuple(record['key'])] = record['answer']
+                elif record['type'] == 'stop':
+                    self.stop = record['reason']
+        # drop the partial line, so that new records are not appended to it
+        if end < os.path.getsize(self.path):
+            os.truncate(self.path, end)
+
+    def _append(self, record):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def record_turn(self, name, content):
+        self.turns.append((name, content))
+        self._append({"type": "turn", "name": name, "content": content})
+
+    def record_answer(self, key, answer):
+        self.answers[key] = answer
+        self._append({"type": "answer", "key": list(key), "answer": answer})
+
+    def record_stop(self, reason):
+        self.stop = reason
+        self._append({"type": "stop", "reason": reason})
+
+    def close(self, remove=False):
+        """close the journal, and remove it once the results of the scene are saved"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if remove and os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,60 @@
+"""
+Policies choosing which judges to query for a question
+"""
+import re
+
+ENSEMBLE_MODES = ('all', 'majority', 'cascade')
+
+HEDGE_PATTERN = re.compile(r"\b(partially|partly|somewhat|unclear|not sure|uncertain|maybe|possibly|hard to say|cannot determine|can't determine)\b", re.IGNORECASE)
+
+
+def is_yes(answer):
+    # the same rule as GoalMetric.judge
+    return 'Yes' in answer
+
+
+def is_certain(answer):
+    """whether a verdict is a plain Yes or No without hedging"""
+    text = answer.strip().lower()
+    return (text.startswith('yes') or text.startswith('no')) and HEDGE_PATTERN.search(text) is None
+
+
+class JudgeEnsemble:
+    """Query judges in waves following a cost order, from the cheapest.
+
+    all: every judge at once.
+    majority: as many judges as needed for a majority, then more only while
+        the majority is undecided.
+    cascade: one judge at a time, escalating to the next one while the verdicts
+        are uncertain.
+
+    Judges not queried get a None verdict.
+    """
+
+    def __init__(self, mode='all', order=None, num_judges=0):
+        if mode not in ENSEMBLE_MODES:
+            raise NotImplementedError("unsupported judge ensemble: {}".format(mode))
+        self.mode = mode
+        self.order = list(order) if order is not None else list(range(num_judges))
+        self.majority = len(self.order) // 2 + 1
+
+    def first(self):
+        """judges of the first wave"""
+        if self.mode == 'majority':
+            return self.order[:self.majority]
+        if self.mode == 'cascade':
+            return self.order[:1]
+        return list(self.order)
+
+    def next(self, verdicts):
+        """judges of the next wave given the verdicts {judge index: answer} so far, none once decided"""
+        remaining = [k for k in self.order if k not in verdicts]
+        if self.mode == 'majority':
+            yes = sum(1 for answer in verdicts.values() if is_yes(answer))
+            lead = max(yes, len(verdicts) - yes)
+            return remaining[:max(self.majority - lead, 0)]
+        if self.mode == 'cascade':
+            if any(is_certain(answer) for answer in verdicts.values()):
+                return []
+            return remaining[:1]
+        return []
@@ -1,5 +1,8 @@
+import collections
 import copy
 import sys
+import threading
+import time
 from typing import Any, Dict, List, Optional, Protocol, Tuple, Union
 import tiktoken
 from termcolor import colored
@@ -8,6 +11,9 @@ from autogen import token_count_utils
 from autogen.cache import AbstractCache, Cache
 from autogen.types import MessageContentType
 from autogen.agentchat.contrib.capabilities import transforms_util
+from openai import OpenAI
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
 
 class TextMessageTruncate:
     """A transform for truncating an incomplete message."""
@@ -61,3 +67,167 @@ class TextMessageTruncate:
             return f"{self._messages_changed} message(s) changed to truncate excess paragraphs.", True
         else:
             return "No messages changed to truncate excess paragraphs.", False
+
+
+class IncrementalTransformMessages:
+    """A replacement of autogen TransformMessages for transforms acting on each message
+    independently, such as TextMessageContentName and TextMessageTruncate.
+
+    The transformed version of each message is remembered by the identity and content
+    of the message, so only newly appended messages are transformed on each reply,
+    with the same output as transforming the whole history again.
+    """
+
+    def __init__(self, transforms):
+        self._transforms = transforms
+        # id(message) -> (message, content, name, transformed message)
+        self._cache = {}
+
+    def add_to_agent(self, agent):
+        agent.register_hook(hookable_method="process_all_messages_before_reply", hook=self._transform_messages)
+
+    def _transform_message(self, message):
+        entry = self._cache.get(id(message))
+        # the message is kept in the entry, so its id cannot be reused by another one
+        if entry is None or entry[0] is not message or entry[1] is not message.get("content") or entry[2] != message.get("name"):
+            processed_messages = [copy.deepcopy(message)]
+            for transform in self._transforms:
+                processed_messages = transform.apply_transform(processed_messages)
+            entry = (message, message.get("content"), message.get("name"), processed_messages[0])
+            self._cache[id(message)] = entry
+        # shallow copy, since autogen may pop keys from the messages it sends
+        return dict(entry[3])
+
+    def _transform_messages(self, messages: List[Dict]) -> List[Dict]:
+        if not messages:
+            return messages
+        if messages[0]["role"] == "system":
+            return [copy.deepcopy(messages[0])] + [self._transform_message(message) for message in messages[1:]]
+        return [self._transform_message(message) for message in messages]
+
+
+class StopSequenceStats:
+    """Per-endpoint statistics of server-side truncation, shared by all agents of a run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ignoring_endpoints = set()
+        self.stats = collections.defaultdict(collections.Counter)
+
+    def ignores_stop(self, endpoint):
+        return endpoint in self.ignoring_endpoints
+
+    def mark_ignoring(self, endpoint):
+        with self.lock:
+            self.ignoring_endpoints.add(endpoint)
+
+    def record(self, endpoint, mode, saved_tokens):
+        with self.lock:
+            self.stats[endpoint][mode] += 1
+            self.stats[endpoint]['saved_tokens'] += max(saved_tokens, 0)
+
+    def log_stats(self, logger):
+        for endpoint, stats in self.stats.items():
+            logger.info('stop sequences [{}] stop requests: {} streamed requests: {} saved decode tokens (upper bound): {}{}'.format(
+                endpoint, stats['stop'], stats['stream'], stats['saved_tokens'],
+                ' (stop ignored, fell back to streaming)' if endpoint in self.ignoring_endpoints else ''))
+
+
+STOP_STATS = StopSequenceStats()
+
+
+def truncated_completion(chunk, text):
+    """build a chat completion from the truncated text of a cancelled stream"""
+    return ChatCompletion(
+        id=chunk.id if chunk is not None else "",
+        object="chat.completion",
+        created=chunk.created if chunk is not None else int(time.time()),
+        model=chunk.model if chunk is not None else "",
+        choices=[Choice(index=0, finish_reason="stop", message=ChatCompletionMessage(role="assistant", content=text))],
+    )
+
+
+def split_stop_params(params):
+    """the truncation symbol and the request params of a stop-sequence request"""
+    params = {k: v for k, v in params.items() if k not in ("model_client_cls", "stream")}
+    stop = params.get("stop")
+    return (stop[0] if isinstance(stop, list) else stop), params
+
+
+def check_stopped(response, trunc_symbol, endpoint, max_tokens):
+    """truncate the response of a stop-sequence request, and detect endpoints ignoring the stop sequence"""
+    choice = response.choices[0]
+    content = choice.message.content or ""
+    if trunc_symbol in content:
+        STOP_STATS.mark_ignoring(endpoint)
+        choice.message.content = content.split(trunc_symbol)[0]
+    completion_tokens = response.usage.completion_tokens if response.usage is not None else max_tokens
+    # vllm reports the matched stop string, other endpoints only the finish reason
+    if getattr(choice, "stop_reason", trunc_symbol) == trunc_symbol and choice.finish_reason == "stop":
+        STOP_STATS.record(endpoint, 'stop', max_tokens - completion_tokens)
+    else:
+        STOP_STATS.record(endpoint, 'stop', 0)
+    return response
+
+
+class StopSequenceClient:
+    """A model client passing the truncation symbol to the server as a stop sequence.
+
+    Endpoints returning text beyond the stop sequence are switched to streaming,
+    where the stream is closed as soon as the truncation symbol arrives.
+    """
+
+    def __init__(self, config, **kwargs):
+        self.endpoint = config["base_url"]
+        self.client = OpenAI(base_url=config["base_url"], api_key=config["api_key"], http_client=config.get("http_client"),
+                             default_headers=config.get("default_headers"))
+        # switched off for interviews, whose answers are not truncated
+        self.enabled = True
+
+    def create(self, params):
+        trunc_symbol, params = split_stop_params(params)
+        if not self.enabled:
+            params.pop("stop", None)
+            return self.client.chat.completions.create(**params)
+        max_tokens = params.get("max_tokens") or 0
+        if not STOP_STATS.ignores_stop(self.endpoint):
+            response = self.client.chat.completions.create(**params)
+            return check_stopped(response, trunc_symbol, self.endpoint, max_tokens)
+
+        text, chunk, n_chunks = "", None, 0
+        stream = self.client.chat.completions.create(stream=True, **params)
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    n_chunks += 1
+                    if trunc_symbol in text:
+                        break
+        finally:
+            # closing the connection aborts the generation on the server
+            stream.close()
+        STOP_STATS.record(self.endpoint, 'stream', max_tokens - n_chunks if trunc_symbol in text else 0)
+        return truncated_completion(chunk, text.split(trunc_symbol)[0])
+
+    def message_retrieval(self, response):
+        return [choice.message.content for choice in response.choices]
+
+    def cost(self, response):
+        return 0.0
+
+    @staticmethod
+    def get_usage(response):
+        usage = response.usage
+        return {
+            "prompt_tokens": usage.prompt_tokens if usage is not None else 0,
+            "completion_tokens": usage.completion_tokens if usage is not None else 0,
+            "total_tokens": usage.total_tokens if usage is not None else 0,
+            "cost": getattr(response, "cost", 0.0),
+            "model": response.model,
+        }
+
+
+# custom model clients referenced by `model_client_cls` in llm configs
+MODEL_CLIENTS = {
+    "StopSequenceClient": StopSequenceClient,
+}
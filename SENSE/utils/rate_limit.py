@@ -0,0 +1,217 @@
+"""
+Adaptive rate limiting and concurrency control of LLM endpoints
+"""
+import asyncio
+import threading
+import time
+import openai
+
+# status codes telling that an endpoint is overloaded
+OVERLOAD_STATUS = (429, 503, 504)
+# exceptions telling that an endpoint is overloaded, raised after the retries of the openai client
+OVERLOAD_ERRORS = (openai.RateLimitError, openai.APITimeoutError)
+
+
+class EndpointController:
+    """Token bucket and AIMD concurrency limit of one endpoint.
+
+    The limit of in-flight requests grows by one per window of healthy requests
+    made while the limit was reached, i.e. whose latency stays within `tolerance`
+    times the baseline latency (or `latency_target` seconds if given), and is
+    multiplied by `backoff` on 429s, 503s and timeouts, at most once per cooldown.
+    Callers waiting for a slot are woken when one is released.
+    """
+
+    def __init__(self, endpoint, rate=0, burst=None, initial_limit=4, min_limit=1, max_limit=64,
+                 latency_target=0, tolerance=2.0, backoff=0.5, logger=None):
+        self.endpoint = endpoint
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # (event loop, future) of the coroutines waiting for a slot
+        self.waiters = []
+        # token bucket, disabled if rate is 0
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        # adaptive concurrency
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.logger = logger
+        self.stats = {"requests": 0, "overloads": 0, "decreases": 0, "max_limit": int(self.limit), "min_limit": int(self.limit)}
+
+    def _try_acquire(self):
+        """take a slot and a token with the lock held, or return the seconds to wait
+        for a token, or None to wait for a free slot"""
+        if self.in_flight >= int(self.limit):
+            return None
+        if self.rate > 0:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.in_flight += 1
+        self.stats["requests"] += 1
+        return 0
+
+    def _wake(self):
+        """wake the threads and coroutines waiting for a slot, with the lock held"""
+        self.cond.notify_all()
+        for loop, waiter in self.waiters:
+            loop.call_soon_threadsafe(set_done, waiter)
+        self.waiters = []
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                wait = self._try_acquire()
+                if wait == 0:
+                    return
+                self.cond.wait(wait)
+
+    async def a_acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                wait = self._try_acquire()
+                if wait == 0:
+                    return
+                waiter = (loop, loop.create_future())
+                self.waiters.append(waiter)
+            await asyncio.wait([waiter[1]], timeout=wait)
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    def release(self, latency, error=None, cached=False):
+        with self.lock:
+            # whether the request was made while the limit was reached
+            bound = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            self._wake()
+            if isinstance(error, OVERLOAD_ERRORS):
+                self._decrease()
+            elif error is None and not cached:
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    # let the baseline drift up slowly as the load changes
+                    self.baseline += 0.01 * (latency - self.baseline)
+                target = self.latency_target if self.latency_target > 0 else self.tolerance * self.baseline
+                # the limit is only raised once tested, not on an idle endpoint
+                if latency <= target and bound:
+                    self._set_limit(min(self.max_limit, self.limit + 1 / self.limit))
+
+    def on_status(self, status_code):
+        """feedback from each http response, including the ones retried by the openai client"""
+        if status_code in OVERLOAD_STATUS:
+            with self.lock:
+                self._decrease()
+
+    def _decrease(self):
+        self.stats["overloads"] += 1
+        now = time.monotonic()
+        # a burst of errors from the same window counts once
+        if now - self.last_decrease < max(self.baseline or 0, 1.0):
+            return
+        self.last_decrease = now
+        self.stats["decreases"] += 1
+        self._set_limit(max(self.min_limit, self.limit * self.backoff))
+
+    def _set_limit(self, limit):
+        old, self.limit = int(self.limit), limit
+        if int(limit) != old:
+            self.stats["max_limit"] = max(self.stats["max_limit"], int(limit))
+            self.stats["min_limit"] = min(self.stats["min_limit"], int(limit))
+            if self.logger is not None:
+                self.logger.info('endpoint {} concurrency limit: {} -> {}'.format(self.endpoint, old, int(limit)))
+
+
+def set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveLimits:
+    """Controllers of all endpoints of the process, disabled until configured."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.controllers = {}
+        self.kwargs = {}
+
+    def configure(self, enabled, logger=None, **kwargs):
+        self.enabled = enabled
+        self.kwargs = dict(kwargs, logger=logger)
+
+    def get(self, endpoint):
+        with self.lock:
+            if endpoint not in self.controllers:
+                self.controllers[endpoint] = EndpointController(endpoint, **self.kwargs)
+            return self.controllers[endpoint]
+
+    def on_response(self, endpoint, response):
+        if self.enabled:
+            self.get(endpoint).on_status(response.status_code)
+
+    async def a_on_response(self, endpoint, response):
+        self.on_response(endpoint, response)
+
+    def wrap_agent(self, agent):
+        """gate the llm calls of an autogen agent by the controller of its endpoint"""
+        self.wrap_client(agent.client, agent.llm_config['config_list'][0]['base_url'])
+
+    def wrap_client(self, client, endpoint):
+        """gate the llm calls of an autogen OpenAIWrapper"""
+        if not self.enabled:
+            return
+        create = client.create
+        controller = self.get(endpoint)
+
+        def limited_create(**kwargs):
+            controller.acquire()
+            start, response, error = time.perf_counter(), None, None
+            try:
+                response = create(**kwargs)
+                return response
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                controller.release(time.perf_counter() - start, error, getattr(response, 'cache_hit', False))
+
+        client.create = limited_create
+
+    async def a_call(self, endpoint, fn, *args):
+        """the asyncio counterpart of the gate of `wrap_agent`"""
+        if not self.enabled:
+            return await fn(*args)
+        controller = self.get(endpoint)
+        await controller.a_acquire()
+        start, error = time.perf_counter(), None
+        try:
+            return await fn(*args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            controller.release(time.perf_counter() - start, error)
+
+    def log_stats(self, logger):
+        for endpoint, controller in self.controllers.items():
+            logger.info('endpoint {} final concurrency limit: {} range: [{}, {}] requests: {} overloads: {} decreases: {}'.format(
+                endpoint, int(controller.limit), controller.stats["min_limit"], controller.stats["max_limit"],
+                controller.stats["requests"], controller.stats["overloads"], controller.stats["decreases"]))
+
+
+LIMITS = AdaptiveLimits()
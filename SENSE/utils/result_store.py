@@ -0,0 +1,129 @@
+"""
+Stores of scene results: one JSON file per scene, or a single indexed SQLite file
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+RESULT_STORES = ('json', 'sqlite')
+
+# fields of a scene result other than its metrics, loaded only when the full result is needed
+TRANSCRIPT_FIELD = 'chat_history'
+ANSWER_FIELDS = ('goal_answer', 'info_answer', 'goal_answer_dist', 'info_answer_dist')
+
+
+def split_result(res):
+    """the metrics, answers and transcript of a scene result"""
+    metrics = {k: v for k, v in res.items() if k != TRANSCRIPT_FIELD and k not in ANSWER_FIELDS}
+    answers = {k: res[k] for k in ANSWER_FIELDS if k in res}
+    return metrics, answers, res.get(TRANSCRIPT_FIELD)
+
+
+class JsonResultStore:
+    """Results saved as <result_dir>/<scene_id>.json, as written by Simulation.save."""
+
+    def __init__(self, result_dir):
+        self.result_dir = result_dir
+
+    def path(self, scene_id):
+        return os.path.join(self.result_dir, '{}.json'.format(scene_id))
+
+    def finished(self):
+        """ids of the scenes with a result, as strings, from a single listing of the dir"""
+        if not os.path.exists(self.result_dir):
+            return set()
+        return {name[:-len('.json')] for name in os.listdir(self.result_dir) if name.endswith('.json')}
+
+    def get(self, scene_id):
+        if not os.path.exists(self.path(scene_id)):
+            return None
+        with open(self.path(scene_id), 'r') as f:
+            return json.load(f)
+
+    def put(self, scene_id, res):
+        with open(self.path(scene_id), 'w') as f:
+            json.dump(res, f)
+
+    def transcript(self, scene_id):
+        res = self.get(scene_id)
+        return res[TRANSCRIPT_FIELD] if res is not None else None
+
+    def metrics(self, scene_ids):
+        """the results of the scenes found, keyed as `scene_ids`, with their transcripts dropped"""
+        finished = self.finished()
+        return {scene_id: split_result(self.get(scene_id))[0] for scene_id in scene_ids if str(scene_id) in finished}
+
+    def close(self):
+        pass
+
+
+class SqliteResultStore:
+    """Results of any number of runs in a single SQLite file, one row per scene of a run,
+    indexed on (model, pattern, scene_id). `tag` separates the results of the eval phase
+    under different judges from those of the simulation, whose tag is empty.
+
+    Metrics, answers and transcript are stored as separate JSON columns, so that metrics
+    are read without parsing the transcripts."""
+
+    def __init__(self, path, model, pattern, tag=None):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.key = (model, pattern, tag or '')
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (model TEXT, pattern TEXT, tag TEXT, scene_id TEXT, "
+                          "metrics TEXT, answers TEXT, transcript TEXT, created REAL, PRIMARY KEY (model, pattern, tag, scene_id))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_scene ON results (model, pattern, scene_id)")
+
+    def finished(self):
+        """ids of the scenes with a result, as strings, from a single query"""
+        with self.lock:
+            rows = self.conn.execute("SELECT scene_id FROM results WHERE model = ? AND pattern = ? AND tag = ?", self.key).fetchall()
+        return {row[0] for row in rows}
+
+    def get(self, scene_id):
+        with self.lock:
+            row = self.conn.execute("SELECT metrics, answers, transcript FROM results WHERE model = ? AND pattern = ? AND tag = ? AND scene_id = ?",
+                                    self.key + (str(scene_id),)).fetchone()
+        if row is None:
+            return None
+        res = dict(json.loads(row[0]), **json.loads(row[1]))
+        res[TRANSCRIPT_FIELD] = json.loads(row[2])
+        return res
+
+    def put(self, scene_id, res):
+        metrics, answers, transcript = split_result(res)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.key + (
+                str(scene_id), json.dumps(metrics), json.dumps(answers), json.dumps(transcript), time.time()))
+
+    def transcript(self, scene_id):
+        with self.lock:
+            row = self.conn.execute("SELECT transcript FROM results WHERE model = ? AND pattern = ? AND tag = ? AND scene_id = ?",
+                                    self.key + (str(scene_id),)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def metrics(self, scene_ids):
+        """the results of the scenes found, keyed as `scene_ids`, without their answers and transcripts"""
+        with self.lock:
+            rows = self.conn.execute("SELECT scene_id, metrics FROM results WHERE model = ? AND pattern = ? AND tag = ?", self.key).fetchall()
+        found = dict(rows)
+        return {scene_id: json.loads(found[str(scene_id)]) for scene_id in scene_ids if str(scene_id) in found}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_result_store(backend, output_dir, tag=None, model=None, pattern=None, db_path=None):
+    """the store of the results of a run under `tag`, json files in output_dir/<tag>, or
+    rows of the sqlite file `db_path`, default to output_dir/results.db"""
+    if backend == 'json':
+        return JsonResultStore(os.path.join(output_dir, tag) if tag else output_dir)
+    if backend == 'sqlite':
+        return SqliteResultStore(db_path or os.path.join(output_dir, 'results.db'), model, pattern, tag)
+    raise NotImplementedError("unsupported result store: {}".format(backend))
@@ -0,0 +1,218 @@
+"""
+Long-format columnar table of scene results, and the metrics computed from it
+with vectorized group-bys
+"""
+import json
+import os
+import numpy as np
+
+COLUMNS = ('model', 'scene_id', 'template_idx', 'agent', 'goal', 'dim', 'judge', 'score')
+STR_COLUMNS = ('model', 'agent', 'goal', 'dim', 'judge')
+DIMS = ('self', 'others', 'judge', 'info')
+
+
+def flatten_result(model, scene_id, template_idx, res):
+    """rows of the goal scores of each agent, goal, dim and judge, and of the info score of each agent"""
+    rows = []
+    goal_metrics = res['goal_metrics']
+    judges = [name for name in goal_metrics if name.startswith('judge') and name not in ('judge_avg', 'judge_majority')]
+    # the metrics of each agent are nested under its name, next to the averages of the scene
+    agents = [name for name, value in goal_metrics.items() if isinstance(value, dict)]
+    for agent in agents:
+        for goal, dims in goal_metrics[agent].items():
+            if not isinstance(dims, dict):
+                # averages of the agent over its goals
+                continue
+            for dim in ('self', 'others'):
+                if dim in dims:
+                    rows.append((model, scene_id, template_idx, agent, goal, dim, '', dims[dim]))
+            if 'judge' in dims:
+                # the score of each judge, followed by their average and majority
+                scores = list(zip(judges, dims['judge'])) + [('judge_avg', dims['judge'][-2]), ('judge_majority', dims['judge'][-1])]
+                for judge, score in scores:
+                    rows.append((model, scene_id, template_idx, agent, goal, 'judge', judge, score))
+    for agent, score in res['info_metrics'].items():
+        if agent != 'avg':
+            rows.append((model, scene_id, template_idx, agent, '', 'info', '', score))
+    return rows
+
+
+def build_table(rows):
+    """columns of rows as numpy arrays"""
+    columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+    table = {}
+    for name, values in zip(COLUMNS, columns):
+        if name == 'score':
+            table[name] = np.array(values, dtype=float)
+        elif name in STR_COLUMNS:
+            table[name] = np.array(values, dtype=str)
+        else:
+            table[name] = np.array([str(v) for v in values], dtype=str)
+    return table
+
+
+def results_table(model, all_res, templates):
+    """the table of the results of a run, `templates` mapping scene ids to their template index"""
+    rows = []
+    for scene_id, res in all_res.items():
+        rows.extend(flatten_result(model, scene_id, templates[scene_id], res))
+    return build_table(rows)
+
+
+def load_run_results(store, input_path):
+    """metrics of the scenes of input_path found in a result store, and the template index of every scene"""
+    templates = {}
+    for line in open(input_path, 'r'):
+        line = json.loads(line)
+        templates[line['sample_idx']] = line['template_idx']
+    return store.metrics(list(templates)), templates
+
+
+def concat_tables(tables):
+    return {name: np.concatenate([table[name] for table in tables]) for name in COLUMNS}
+
+
+def write_table(table, path):
+    """write a table as parquet, which requires pyarrow, or as a numpy .npz archive"""
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    if path.endswith('.npz'):
+        np.savez_compressed(path, **table)
+        return
+    pa, pq = import_pyarrow()
+    pq.write_table(pa.table({name: table[name] for name in COLUMNS}), path)
+
+
+def read_table(path):
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            return {name: data[name] for name in COLUMNS}
+    _, pq = import_pyarrow()
+    data = pq.read_table(path)
+    return {name: data.column(name).to_numpy(zero_copy_only=False).astype(float if name == 'score' else str) for name in COLUMNS}
+
+
+def load_tables(paths):
+    return concat_tables([read_table(path) for path in paths])
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required for parquet tables, install it or use a .npz path.")
+    return pyarrow, pyarrow.parquet
+
+
+def group_by(*keys):
+    """the unique rows of the key columns, and the group of each row"""
+    codes = [np.unique(key, return_inverse=True) for key in keys]
+    stacked = np.stack([inverse.ravel() for _, inverse in codes], axis=1) if len(keys) else np.zeros((0, 0), dtype=int)
+    groups, inverse = np.unique(stacked, axis=0, return_inverse=True)
+    uniques = [values[groups[:, i]] for i, (values, _) in enumerate(codes)]
+    return uniques, inverse.ravel()
+
+
+def group_mean(inverse, num_groups, values, skipna=False):
+    """mean of each group, skipping nan values as np.nanmean with `skipna`, otherwise
+    propagating them as np.mean"""
+    mask = ~np.isnan(values) if skipna else np.ones(len(values), dtype=bool)
+    counts = np.bincount(inverse[mask], minlength=num_groups)
+    sums = np.bincount(inverse[mask], weights=values[mask], minlength=num_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan), counts
+
+
+def group_std(inverse, num_groups, values, means, counts, skipna=False):
+    """sample std (ddof=1) of each group given its mean, nan for groups of less than 2 values"""
+    mask = ~np.isnan(values) if skipna else np.ones(len(values), dtype=bool)
+    squares = np.bincount(inverse[mask], weights=(values[mask] - means[inverse[mask]]) ** 2, minlength=num_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 1, np.sqrt(squares / np.maximum(counts - 1, 1)), np.nan)
+
+
+def subset(columns, rows):
+    return {name: values[rows] for name, values in columns.items()}
+
+
+def by_nan_policy(columns, fn, skip_dims):
+    """concatenate fn(columns, skipna) applied to the rows of `skip_dims`, whose nan scores
+    are skipped as by np.nanmean, and to the other rows, where they propagate as by np.mean"""
+    parts = []
+    skip = np.isin(columns['dim'], skip_dims)
+    for skipna in (False, True):
+        if (skip == skipna).any():
+            parts.append(fn(subset(columns, skip == skipna), skipna))
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]} if parts else {}
+
+
+def reduce(columns, keys, skipna, value='score'):
+    """mean of `value` over the rows sharing the `keys` columns, the other columns being dropped"""
+    uniques, inverse = group_by(*(columns[name] for name in keys))
+    means, _ = group_mean(inverse, len(uniques[0]), columns[value], skipna)
+    return dict(zip(keys, uniques), **{value: means})
+
+
+def scene_scores(table):
+    """the score of each model, scene, dim and judge, averaged over goals for each agent
+    and then over agents, as GoalMetric and SingleChoiceMetric. Judges skipped by the
+    ensemble have nan scores, averaged over the queried judges."""
+    def average(columns, skipna):
+        agents = reduce(columns, ('model', 'scene_id', 'template_idx', 'agent', 'dim', 'judge'), skipna)
+        return reduce(agents, ('model', 'scene_id', 'template_idx', 'dim', 'judge'), skipna)
+    return by_nan_policy(table, average, ('judge',))
+
+
+def template_scores(scenes):
+    """the mean and std over the scenes of each model, template, dim and judge, as MetricAggregator.template_res"""
+    def stats(columns, skipna):
+        keys = ('model', 'template_idx', 'dim', 'judge')
+        uniques, inverse = group_by(*(columns[name] for name in keys))
+        means, counts = group_mean(inverse, len(uniques[0]), columns['score'], skipna)
+        stds = group_std(inverse, len(uniques[0]), columns['score'], means, counts, skipna)
+        return dict(zip(keys, uniques), score=means, std=stds, scenes=counts)
+    return by_nan_policy(scenes, stats, ('judge',))
+
+
+def leaderboard(table):
+    """the scene-level and template-level averages of each model, dim and judge. The
+    template-level std is the mean over templates of the std within each template (PSI).
+    As in MetricAggregator.tmpl_res, self and others are averaged over all templates, which is
+    nan if a template has a single scene, and judges and info over the templates where
+    they are defined."""
+    scenes = scene_scores(table)
+    if not scenes:
+        return {}
+    keys = ('model', 'dim', 'judge')
+    scene_avg = by_nan_policy(scenes, lambda columns, skipna: reduce(columns, keys, skipna), ('judge',))
+    scene_avg = {tuple(row[:-1]): row[-1] for row in zip(*(scene_avg[name] for name in keys), scene_avg['score'])}
+
+    def average(columns, skipna):
+        uniques, inverse = group_by(*(columns[name] for name in keys))
+        scores, counts = group_mean(inverse, len(uniques[0]), columns['score'], skipna)
+        psi, _ = group_mean(inverse, len(uniques[0]), columns['std'], skipna)
+        return dict(zip(keys, uniques), score=scores, psi=psi, templates=counts)
+    board = by_nan_policy(template_scores(scenes), average, ('judge', 'info'))
+    board['template_score'] = board.pop('score')
+    board['scene_score'] = np.array([scene_avg[k] for k in zip(*(board[name] for name in keys))])
+    return board
+
+
+def format_leaderboard(board, digits=4):
+    """a markdown table with one row per model and the template-level score and PSI of each dim"""
+    columns = sorted({(dim, judge) for dim, judge in zip(board['dim'], board['judge'])},
+                     key=lambda c: (DIMS.index(c[0]) if c[0] in DIMS else len(DIMS), c[1]))
+    cells = {(m, d, j): (s, p) for m, d, j, s, p in zip(board['model'], board['dim'], board['judge'], board['template_score'], board['psi'])}
+    header = ['model'] + [judge or dim for dim, judge in columns]
+    lines = ['| ' + ' | '.join(header) + ' |', '|' + '---|' * len(header)]
+    for model in sorted(set(board['model'])):
+        row = [model]
+        for dim, judge in columns:
+            if (model, dim, judge) in cells:
+                score, psi = cells[(model, dim, judge)]
+                row.append('{} ({})'.format(round(float(score), digits), round(float(psi), digits)))
+            else:
+                row.append('-')
+        lines.append('| ' + ' | '.join(row) + ' |')
+    return '\n'.join(lines)
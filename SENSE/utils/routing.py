@@ -0,0 +1,212 @@
+"""
+Routing of requests over the replicas serving a model
+"""
+import bisect
+import hashlib
+import math
+import threading
+import time
+
+ROUTING_MODES = ('sticky', 'least_outstanding')
+
+# header carrying the route key of a request, set per scene in its llm configs
+ROUTE_HEADER = 'X-Route-Key'
+
+
+def replicas(base_url):
+    """the base urls of an llm config, given as a single url, a list or comma-separated"""
+    if isinstance(base_url, (list, tuple)):
+        return list(base_url)
+    return [url.strip() for url in base_url.split(',') if url.strip()]
+
+
+def hash_key(key):
+    return int(hashlib.md5(str(key).encode('utf-8')).hexdigest(), 16)
+
+
+class HashRing:
+    """Consistent hash ring with `vnodes` points per node, so that adding or removing
+    a replica only moves the keys of its neighbours."""
+
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = list(nodes)
+        points = sorted((hash_key('{}#{}'.format(node, i)), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.points = [node for _, node in points]
+
+    def get(self, key, exclude=()):
+        """the node of a key, skipping the nodes in `exclude` if any other is left"""
+        start = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        for offset in range(len(self.points)):
+            node = self.points[(start + offset) % len(self.points)]
+            if node not in exclude:
+                return node
+        return self.points[start]
+
+
+def route_task_config(task_config):
+    """tag the llm configs of a scene served by several replicas with the scene id as
+    route key, so that its requests can stick to one replica and reuse its prefix cache"""
+    key = str(task_config['scene']['scene_id'])
+    for agent_config in task_config['agents'] + task_config['judge_agents']:
+        llm = agent_config['llm']
+        if len(replicas(llm['base_url'])) > 1:
+            headers = dict(llm.get('default_headers') or {}, **{ROUTE_HEADER: key})
+            agent_config['llm'] = dict(llm, default_headers=headers)
+    return task_config
+
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.evictions = 0
+        self.evicted_until = 0.0
+        # an evicted replica is admitted back once its models route answers after the cooldown
+        self.needs_probe = False
+        self.probing = False
+        # moving average of the latency since the last eviction
+        self.latency = None
+        self.samples = 0
+        self.total_latency = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def healthy(self, now):
+        return self.evicted_until <= now and not self.needs_probe
+
+
+class ReplicaSet:
+    """Replicas of a model, with requests routed to the least outstanding healthy replica.
+
+    sticky: requests with a route key go to the replica of the key on a consistent hash
+        ring, unless it holds more than `load_factor` times its share of the outstanding
+        requests, so that a scene reuses the prefix cache of one replica while the load
+        stays bounded.
+    least_outstanding: route keys are ignored.
+
+    A replica is evicted for `cooldown` seconds after `max_errors` consecutive errors
+    (connection errors, 429 or 5xx), or once its latency exceeds `slow_factor` times the
+    median latency of the other replicas. After the cooldown, its models route is probed in
+    the background, and it is admitted back on trial if the probe succeeds, otherwise evicted
+    for another cooldown. A replica on trial is evicted again by its next error. The last
+    healthy replica is never evicted.
+    """
+
+    def __init__(self, urls, routing='sticky', max_errors=3, slow_factor=3.0, cooldown=30.0,
+                 load_factor=1.25, min_samples=5, alpha=0.2, probe_timeout=5.0, logger=None):
+        if routing not in ROUTING_MODES:
+            raise NotImplementedError("unsupported replica routing: {}".format(routing))
+        self.replicas = [Replica(url) for url in urls]
+        self.by_url = {r.url: r for r in self.replicas}
+        self.ring = HashRing(self.by_url)
+        self.routing = routing
+        self.max_errors = max_errors
+        self.slow_factor = slow_factor
+        self.cooldown = cooldown
+        self.load_factor = load_factor
+        self.min_samples = min_samples
+        self.alpha = alpha
+        self.probe_timeout = probe_timeout
+        self.logger = logger
+        self.lock = threading.Lock()
+
+    def pick(self, key=None):
+        """choose the replica of a request and count it as outstanding"""
+        with self.lock:
+            now = time.monotonic()
+            for r in self.replicas:
+                if r.needs_probe and not r.probing and r.evicted_until <= now:
+                    r.probing = True
+                    threading.Thread(target=self._readmit, args=(r,), daemon=True).start()
+            healthy = [r for r in self.replicas if r.healthy(now)] or self.replicas
+            replica = None
+            if key is not None and self.routing == 'sticky':
+                unhealthy = {r.url for r in self.replicas if r not in healthy}
+                candidate = self.by_url[self.ring.get(key, exclude=unhealthy)]
+                total = sum(r.outstanding for r in healthy)
+                if candidate.outstanding + 1 <= math.ceil(self.load_factor * (total + 1) / len(healthy)):
+                    replica = candidate
+            if replica is None:
+                replica = min(healthy, key=lambda r: (r.outstanding, r.latency or 0.0))
+            replica.outstanding += 1
+            if replica.first_start is None:
+                replica.first_start = now
+            return replica
+
+    def release(self, replica, latency, status=None, error=None):
+        """count the end of a request, evicting its replica if it is erroring or slow"""
+        failed = error is not None or (status is not None and (status == 429 or status >= 500))
+        with self.lock:
+            now = time.monotonic()
+            replica.outstanding -= 1
+            replica.requests += 1
+            replica.last_end = now
+            if failed:
+                replica.errors += 1
+                replica.consecutive_errors += 1
+                if replica.consecutive_errors >= self.max_errors:
+                    self._evict(replica, now, 'errors: {}'.format(replica.consecutive_errors))
+                return
+            replica.consecutive_errors = 0
+            replica.total_latency += latency
+            replica.samples += 1
+            replica.latency = latency if replica.latency is None else self.alpha * latency + (1 - self.alpha) * replica.latency
+            others = sorted(r.latency for r in self.replicas
+                            if r is not replica and r.healthy(now) and r.samples >= self.min_samples)
+            if replica.samples >= self.min_samples and others and replica.latency > self.slow_factor * others[len(others) // 2]:
+                self._evict(replica, now, 'latency: {:.3f}s'.format(replica.latency))
+
+    def _evict(self, replica, now, reason):
+        if not any(r.healthy(now) for r in self.replicas if r is not replica):
+            return
+        replica.evicted_until = now + self.cooldown
+        replica.needs_probe = True
+        replica.evictions += 1
+        replica.latency, replica.samples = None, 0
+        if self.logger is not None:
+            self.logger.warning('replica {} evicted for {}s, {}'.format(replica.url, self.cooldown, reason))
+
+    def probe(self, replica):
+        """whether the models route of a replica answers without a server error"""
+        import httpx
+        try:
+            return httpx.get(replica.url.rstrip('/') + '/models', timeout=self.probe_timeout).status_code < 500
+        except httpx.HTTPError:
+            return False
+
+    def _readmit(self, replica):
+        """admit back a replica whose cooldown expired if its probe succeeds"""
+        healthy = self.probe(replica)
+        with self.lock:
+            replica.probing = False
+            now = time.monotonic()
+            if healthy:
+                replica.needs_probe = False
+                if self.logger is not None:
+                    self.logger.info('replica {} admitted back after a health check'.format(replica.url))
+            else:
+                replica.evicted_until = now + self.cooldown
+                if self.logger is not None:
+                    self.logger.warning('replica {} evicted for {}s, failed health check'.format(replica.url, self.cooldown))
+
+    def check_health(self):
+        """probe the models route of each replica, evicting those unreachable or failing"""
+        for replica in self.replicas:
+            if not self.probe(replica):
+                with self.lock:
+                    self._evict(replica, time.monotonic(), 'failed health check')
+
+    def log_stats(self, logger):
+        for replica in self.replicas:
+            if not replica.requests:
+                continue
+            span = (replica.last_end or 0) - (replica.first_start or 0)
+            successes = replica.requests - replica.errors
+            logger.info('replica {} requests: {} errors: {} evictions: {} throughput: {} req/s mean latency: {}'.format(
+                replica.url, replica.requests, replica.errors, replica.evictions,
+                round(replica.requests / span, 3) if span > 0 else 'NONE',
+                round(replica.total_latency / successes, 3) if successes else 'NONE'))
@@ -0,0 +1,87 @@
+"""
+Cost-aware dispatch order of scenes
+"""
+import threading
+import numpy as np
+
+
+class SceneCostModel:
+    """Estimate the duration of a scene from its task config, as a linear model of
+    its llm calls refitted by ridge regression on the durations observed during the run.
+
+    Features: per scene, per dialog turn, per interview question, per kchar of
+    prompt per call, and per interview question per dialog turn (the transcript
+    each interview reads grows with the dialog).
+    """
+
+    # prior weights in seconds, which only need the right proportions before the first observations
+    PRIOR = np.array([1.0, 1.0, 0.5, 0.05, 0.01])
+
+    def __init__(self, simulate=True, ridge=1.0):
+        # no dialog turns when re-judging saved transcripts
+        self.simulate = simulate
+        self.lock = threading.Lock()
+        self.A = ridge * np.eye(len(self.PRIOR))
+        self.b = ridge * self.PRIOR
+        self.weights = self.PRIOR.copy()
+        self.observations = 0
+
+    def features(self, task_config):
+        scene = task_config['scene']
+        dialog_calls = max(task_config['groupchat']['max_round'] - 1, 0) if self.simulate else 0
+        num_judges = len(task_config['judge_agents'])
+        eval_calls = 0
+        for goals in scene['goal_question'].values():
+            for goal in goals:
+                for dim, questions in goal['eval_questions'].items():
+                    eval_calls += len(questions) * (num_judges if dim == 'judge' else 1)
+        eval_calls += sum(len(questions) for questions in scene['info_question'].values())
+        prompt_kchars = (len(scene['background']) + len(scene['desc']) + sum(
+            len(agent['profile']) + len(agent['private_info']) + len(agent['prompt_template']) + sum(len(goal) for goal in agent['social_goal'])
+            for agent in task_config['agents'])) / 1000
+        return np.array([1.0, dialog_calls, eval_calls, (dialog_calls + eval_calls) * prompt_kchars, eval_calls * dialog_calls])
+
+    def observe(self, features, duration):
+        with self.lock:
+            self.A += np.outer(features, features)
+            self.b += features * duration
+            self.weights = np.linalg.solve(self.A, self.b)
+            self.observations += 1
+
+
+class SceneScheduler:
+    """Pending scenes dispatched longest first by the estimates of a SceneCostModel,
+    which are refreshed as the durations of finished scenes come in."""
+
+    def __init__(self, configs, cost_model):
+        self.configs = list(configs)
+        self.cost_model = cost_model
+        self.features = np.array([cost_model.features(config) for config in self.configs]).reshape(len(self.configs), len(cost_model.PRIOR))
+        self.pending = list(range(len(self.configs)))
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def estimates(self):
+        return self.features @ self.cost_model.weights
+
+    def pop(self):
+        """the pending scene with the longest estimated duration, with its features"""
+        with self.lock:
+            estimates = self.features[self.pending] @ self.cost_model.weights
+            idx = self.pending.pop(int(np.argmax(estimates)))
+        return self.configs[idx], self.features[idx]
+
+    def observe(self, features, duration):
+        self.cost_model.observe(features, duration)
+
+    def log_plan(self, logger):
+        estimates = self.estimates()
+        if len(estimates):
+            logger.info('scene cost estimates min: {:.1f} median: {:.1f} max: {:.1f} total: {:.1f} (prior weights)'.format(
+                estimates.min(), np.median(estimates), estimates.max(), estimates.sum()))
+
+    def log_stats(self, logger):
+        logger.info('scene cost model fitted on {} scenes, weights: {}'.format(
+            self.cost_model.observations, [round(float(w), 4) for w in self.cost_model.weights]))
@@ -0,0 +1,99 @@
+"""
+Bootstrap confidence intervals and paired significance of template-level scores
+"""
+import numpy as np
+
+# max num of resampled scores held in memory at once, bounding the size of a chunk of replicates
+MAX_ELEMENTS = 1 << 22
+
+
+def scene_metrics(all_res):
+    """the scene-level score of each metric, {metric: {scene_id: score}}, from goal_metrics
+    and info_metrics. Scenes without info questions have no info score"""
+    metrics = {}
+    for scene_id, res in all_res.items():
+        goal_metrics = res['goal_metrics']
+        scores = {'goal_self': goal_metrics['self'], 'goal_others': goal_metrics['others']}
+        scores.update({name: goal_metrics[name] for name in goal_metrics if name.startswith('judge')})
+        if res['info_metrics']:
+            scores['info'] = res['info_metrics']['avg']
+        for metric, score in scores.items():
+            metrics.setdefault(metric, {})[scene_id] = score
+    return metrics
+
+
+def stratify(values, strata):
+    """the values sorted by stratum with nan values dropped, and the offset and size of each stratum"""
+    values = np.asarray(values, dtype=float)
+    strata = np.asarray([str(s) for s in strata])
+    keep = ~np.isnan(values)
+    values, strata = values[keep], strata[keep]
+    order = np.argsort(strata, kind='stable')
+    values, strata = values[order], strata[order]
+    _, offsets, sizes = np.unique(strata, return_index=True, return_counts=True)
+    return values, offsets, sizes
+
+
+def template_average(values, offsets, sizes):
+    """the mean over strata of the mean within each stratum, the headline score of MetricAggregator.tmpl_res"""
+    return float(np.mean(np.add.reduceat(values, offsets) / sizes))
+
+
+def stratified_bootstrap(values, strata, num_samples=10000, seed=0):
+    """`num_samples` bootstrap replicates of the template average, each resampling the scenes
+    of every template with replacement so that the num of scenes per template is kept"""
+    values, offsets, sizes = stratify(values, strata)
+    if not len(values):
+        return np.full(num_samples, np.nan)
+    # the offset and size of the stratum of every position
+    starts = np.repeat(offsets, sizes)
+    lengths = np.repeat(sizes, sizes)
+    rng = np.random.default_rng(seed)
+    replicates = np.empty(num_samples)
+    chunk = max(1, MAX_ELEMENTS // len(values))
+    for begin in range(0, num_samples, chunk):
+        num = min(chunk, num_samples - begin)
+        index = starts + (rng.random((num, len(values))) * lengths).astype(np.int64)
+        sums = np.add.reduceat(values[index], offsets, axis=1)
+        replicates[begin:begin + num] = (sums / sizes).mean(axis=1)
+    return replicates
+
+
+def bootstrap_ci(values, strata, num_samples=10000, alpha=0.05, seed=0, return_replicates=False):
+    """the template average and its percentile bootstrap confidence interval at level 1-alpha"""
+    sorted_values, offsets, sizes = stratify(values, strata)
+    replicates = stratified_bootstrap(values, strata, num_samples, seed)
+    if not len(sorted_values):
+        res = {'score': np.nan, 'low': np.nan, 'high': np.nan, 'scenes': 0}
+    else:
+        low, high = np.percentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+        res = {'score': template_average(sorted_values, offsets, sizes), 'low': float(low), 'high': float(high),
+               'scenes': int(len(sorted_values))}
+    return (res, replicates) if return_replicates else res
+
+
+def paired_test(scores_a, scores_b, templates, num_samples=10000, alpha=0.05, seed=0):
+    """difference of the template averages of two runs over the scenes scored in both, with its
+    bootstrap confidence interval and two-sided p-value, resampling the per-scene differences
+    within templates so that the pairing of the scenes is kept"""
+    common = [scene_id for scene_id in scores_a if scene_id in scores_b]
+    diffs = np.array([scores_a[scene_id] - scores_b[scene_id] for scene_id in common], dtype=float)
+    res, replicates = bootstrap_ci(diffs, [templates[scene_id] for scene_id in common], num_samples, alpha, seed, return_replicates=True)
+    res['diff'] = res.pop('score')
+    res['p_value'] = float(min(1.0, 2 * min(np.mean(replicates <= 0), np.mean(replicates >= 0)))) if res['scenes'] else np.nan
+    return res
+
+
+def bootstrap_report(all_res, templates, num_samples=10000, alpha=0.05, seed=0):
+    """the bootstrap confidence interval of the template average of every metric"""
+    report = {}
+    for metric, scores in scene_metrics(all_res).items():
+        report[metric] = bootstrap_ci(list(scores.values()), [templates[scene_id] for scene_id in scores], num_samples, alpha, seed)
+    return report
+
+
+def compare_runs(all_res_a, all_res_b, templates, num_samples=10000, alpha=0.05, seed=0):
+    """the paired difference between two runs of every metric they share"""
+    metrics_a, metrics_b = scene_metrics(all_res_a), scene_metrics(all_res_b)
+    return {metric: paired_test(metrics_a[metric], metrics_b[metric], templates, num_samples, alpha, seed)
+            for metric in metrics_a if metric in metrics_b}
@@ -0,0 +1,88 @@
+"""
+Early termination of dialogs on farewells, repetition or by a classifier
+"""
+import re
+
+FAREWELL_PATTERN = re.compile(
+    r"\b(good ?bye|bye|farewell|see you|take care|talk (to you )?(later|soon)|catch you later|"
+    r"have a (good|great|nice|wonderful) (day|night|evening|one|weekend))\b", re.IGNORECASE)
+
+TRIGGERS = ('farewell', 'repetition', 'classifier')
+
+
+def ngrams(text, n):
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+class TerminationPolicy:
+    """Stateful `is_termination_msg` of a group chat manager, which sees every
+    message of the group chat in order.
+
+    The dialog ends once the last `farewell_turns` turns are farewells, once
+    `repetition_turns` consecutive turns each share at least `repetition_threshold`
+    of their word n-grams with one of the `window` turns before them, or once
+    the classifier, asked every `classify_every` turns, says the dialog has ended.
+    No trigger fires before `min_turns` turns.
+    """
+
+    def __init__(self, triggers=('farewell', 'repetition'), min_turns=4, farewell_turns=2,
+                 ngram=3, window=4, repetition_threshold=0.6, repetition_turns=2, classify_every=3):
+        for trigger in triggers:
+            if trigger not in TRIGGERS:
+                raise NotImplementedError("unsupported termination trigger: {}".format(trigger))
+        self.triggers = triggers
+        self.min_turns = min_turns
+        self.farewell_turns = farewell_turns
+        self.ngram = ngram
+        self.window = window
+        self.repetition_threshold = repetition_threshold
+        self.repetition_turns = repetition_turns
+        self.classify_every = classify_every
+        # callables of the (name, content) turns, set by the simulation
+        self.classifier = None
+        self.a_classifier = None
+        self.turns = []
+        self.repetitive = 0
+        self.reason = None
+
+    def observe(self, name, content):
+        """add a turn without checking it, e.g. when replaying the journal of a scene"""
+        content = content if isinstance(content, str) else ""
+        grams = ngrams(content, self.ngram)
+        recent = [ngrams(c, self.ngram) for _, c in self.turns[-self.window:]]
+        if grams and any(len(grams & other) / len(grams) >= self.repetition_threshold for other in recent):
+            self.repetitive += 1
+        else:
+            self.repetitive = 0
+        self.turns.append((name, content))
+
+    def check_rules(self):
+        if len(self.turns) < self.min_turns:
+            return None
+        if 'farewell' in self.triggers and all(FAREWELL_PATTERN.search(c) for _, c in self.turns[-self.farewell_turns:]):
+            return 'farewell'
+        if 'repetition' in self.triggers and self.repetitive >= self.repetition_turns:
+            return 'repetition'
+        return None
+
+    def classifier_due(self):
+        return 'classifier' in self.triggers and len(self.turns) >= self.min_turns \
+            and (len(self.turns) - self.min_turns) % self.classify_every == 0
+
+    def __call__(self, message):
+        self.observe(message.get("name"), message.get("content"))
+        reason = self.check_rules()
+        if reason is None and self.classifier_due() and self.classifier is not None and self.classifier(self.turns):
+            reason = 'classifier'
+        self.reason = reason
+        return reason is not None
+
+    async def a_call(self, name, content):
+        """the asyncio counterpart of `__call__`"""
+        self.observe(name, content)
+        reason = self.check_rules()
+        if reason is None and self.classifier_due() and self.a_classifier is not None and await self.a_classifier(self.turns):
+            reason = 'classifier'
+        self.reason = reason
+        return reason is not None